@@ -0,0 +1,221 @@
+import os, json, argparse
+from datetime import date, timedelta
+from decimal import Decimal
+import pandas as pd
+from db import run_query
+from pipeline_state import get_cursor, save_cursor
+from tenants import current_tenant, use_tenant, get_tenant
+
+# Local analytics: daily Parquet partitions of the OLTP tables, queried with DuckDB.
+# Needs pyarrow, and duckdb for reports, which are not part of the deployed requirements.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_START_DATE = date.fromisoformat(os.getenv('SNAPSHOT_START_DATE', '2025-08-01'))
+# Days before the last exported one that are always re-exported (late webhook edits, Ads
+# conversions reported after the fact). Older days are re-exported when they are known to have changed.
+SNAPSHOT_TRAILING_DAYS = int(os.getenv('SNAPSHOT_TRAILING_DAYS', 3))
+SNAPSHOT_CURSOR_STAGE = 'analytics_snapshots'
+
+# table -> date column used for the daily partitions
+SNAPSHOT_TABLES = {
+    "ga_events": "event_timestamp",
+    "orders": "shopify_order_date",
+    "order_items": "shopify_order_date",
+    "ads_metrics": "segment_date"
+}
+
+def _table_dir(table):
+    # One tree per tenant, like the per-tenant schemas they are exported from
+    return os.path.join(SNAPSHOT_DIR, current_tenant()['name'], table)
+
+def _last_snapshot_day(table):
+    if not os.path.isdir(_table_dir(table)):
+        return None
+    days = [name.split('=', 1)[1] for name in os.listdir(_table_dir(table)) if name.startswith('day=')]
+    return date.fromisoformat(max(days)) if days else None
+
+def _to_parquet_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def export_table_day(table, day):
+    date_column = SNAPSHOT_TABLES[table]
+    rows = run_query(
+        f"SELECT * FROM {table} WHERE {date_column} >= %s AND {date_column} < %s",
+        (day, day + timedelta(days=1)), fetch_all=True
+    ) or []
+    day_file = os.path.join(_table_dir(table), f"day={day.isoformat()}", 'part-0.parquet')
+    if not rows:
+        # The day may have been exported before and emptied since (retention)
+        if os.path.exists(day_file):
+            os.remove(day_file)
+        return 0
+
+    df = pd.DataFrame([{key: _to_parquet_value(value) for key, value in row.items()} for row in rows])
+    os.makedirs(os.path.dirname(day_file), exist_ok=True)
+    df.to_parquet(day_file, index=False)
+    return len(df)
+
+def changed_days(table, since):
+    # Days rewritten in Postgres since the last export: orders matched later (their UTMs live on
+    # the order row) and days rebuilt by backfill.py
+    if since is None:
+        return set()
+    days = set()
+    if table == 'orders':
+        rows = run_query(
+            "SELECT DISTINCT DATE(shopify_order_date) AS day FROM orders WHERE matched_at >= %s",
+            (since,), fetch_all=True
+        ) or []
+        days.update(row['day'] for row in rows)
+
+    backfill_source = {'ga_events': 'ga', 'orders': 'shopify', 'order_items': 'shopify'}.get(table)
+    if backfill_source:
+        rows = run_query(
+            """
+            SELECT shard_date AS day FROM backfill_shards
+            WHERE source = %s AND status = 'done' AND updated_at >= %s
+            """, (backfill_source, since), fetch_all=True
+        ) or []
+        days.update(row['day'] for row in rows)
+    return days
+
+def export_snapshots(tables=None, until=None, from_date=None):
+    # Incremental: each table restarts SNAPSHOT_TRAILING_DAYS before its last exported day, plus
+    # any older day that changed since the previous export. from_date forces a re-export from there.
+    until = until or date.today()
+    started = run_query("SELECT NOW() AS now", fetch_one=True)['now']
+    cursor = get_cursor(SNAPSHOT_CURSOR_STAGE) or {}
+    since = cursor.get('exported_at')
+
+    for table in tables or SNAPSHOT_TABLES:
+        last_day = _last_snapshot_day(table)
+        if from_date:
+            first_day = from_date
+        elif last_day:
+            first_day = max(last_day - timedelta(days=SNAPSHOT_TRAILING_DAYS), SNAPSHOT_START_DATE)
+        else:
+            first_day = SNAPSHOT_START_DATE
+
+        days = {first_day + timedelta(days=i) for i in range((until - first_day).days + 1)}
+        days.update(day for day in changed_days(table, since) if day <= until)
+        exported = sum(export_table_day(table, day) for day in sorted(days))
+        print(f"Snapshot {table}: {exported} rows exported over {len(days)} days")
+
+    # products is small and has no date, it is rewritten as a whole
+    products = run_query("SELECT shopify_product_id, handle FROM products", fetch_all=True) or []
+    os.makedirs(_table_dir('products'), exist_ok=True)
+    pd.DataFrame(products, columns=['shopify_product_id', 'handle']).to_parquet(
+        os.path.join(_table_dir('products'), 'products.parquet'), index=False
+    )
+    save_cursor(SNAPSHOT_CURSOR_STAGE, {"exported_at": started.isoformat()})
+
+def connect_snapshots():
+    # Only reports need duckdb; export runs without it
+    import duckdb
+    con = duckdb.connect()
+    for table in SNAPSHOT_TABLES:
+        if os.path.isdir(_table_dir(table)):
+            con.execute(
+                f"CREATE VIEW {table} AS SELECT * FROM read_parquet(?, hive_partitioning = true, union_by_name = true)",
+                [os.path.join(_table_dir(table), 'day=*', '*.parquet')]
+            )
+    if os.path.isdir(_table_dir('products')):
+        con.execute("CREATE VIEW products AS SELECT * FROM read_parquet(?)", [os.path.join(_table_dir('products'), '*.parquet')])
+    return con
+
+def ads_vs_revenue(con, from_date, to_date):
+    # Same shape and revenue crediting as get_ga4_urls.query_ads_revenue, over the snapshot files
+    return con.execute(
+        """
+        WITH ads AS (
+            SELECT
+                target_page, gad_campaignid, campaign,
+                SUM(impressions) AS impressions,
+                SUM(clicks) AS clicks,
+                SUM(conversions) AS conversions,
+                SUM(cost_micros) / 1000000.0 AS cost
+            FROM ads_metrics
+            WHERE segment_date BETWEEN ? AND ?
+                AND target_page IS NOT NULL AND gad_campaignid IS NOT NULL
+            GROUP BY ALL
+        ),
+        ranked_ads AS (
+            SELECT
+                ads.*,
+                ROW_NUMBER() OVER (PARTITION BY target_page, gad_campaignid ORDER BY impressions DESC, campaign) AS key_rank
+            FROM ads
+        ),
+        revenue AS (
+            SELECT
+                target_page, gad_campaignid,
+                SUM(shopify_order_total - shopify_delivery_price) AS total_revenue,
+                COUNT(*) AS total_purchases
+            FROM orders
+            WHERE CAST(shopify_order_date AS DATE) BETWEEN ? AND ?
+                AND landing_utm_source = 'google'
+            GROUP BY ALL
+        )
+        SELECT
+            ranked_ads.* EXCLUDE (key_rank),
+            COALESCE(revenue.total_revenue, 0) AS total_revenue,
+            COALESCE(revenue.total_purchases, 0) AS total_purchases
+        FROM ranked_ads
+        LEFT JOIN revenue
+            ON revenue.target_page = ranked_ads.target_page
+            AND revenue.gad_campaignid = ranked_ads.gad_campaignid
+            AND ranked_ads.key_rank = 1
+        ORDER BY ranked_ads.impressions DESC
+        """, [from_date, to_date, from_date, to_date]
+    ).df()
+
+def product_spend(con, from_date, to_date):
+    # Per-product revenue from Google-sourced orders next to the Ads spend on the product's own page.
+    # Revenue is SUM(price), the definition of get_ga4_urls.query_product_revenue and summarize_all
+    return con.execute(
+        """
+        WITH product_revenue AS (
+            SELECT products.handle, SUM(order_items.price) AS revenue, COUNT(DISTINCT order_items.shopify_order_id) AS orders
+            FROM order_items
+            JOIN orders USING (shopify_order_id)
+            JOIN products ON products.shopify_product_id = order_items.item_id
+            WHERE CAST(order_items.shopify_order_date AS DATE) BETWEEN ? AND ?
+                AND orders.landing_utm_source = 'google'
+            GROUP BY ALL
+        ),
+        product_ads AS (
+            SELECT target_page, SUM(impressions) AS imp, SUM(clicks) AS click, SUM(conversions) AS conv, SUM(cost_micros) / 1000000.0 AS cost
+            FROM ads_metrics
+            WHERE segment_date BETWEEN ? AND ?
+            GROUP BY ALL
+        )
+        SELECT
+            product_revenue.*,
+            COALESCE(product_ads.imp, 0) AS imp,
+            COALESCE(product_ads.click, 0) AS click,
+            COALESCE(product_ads.conv, 0) AS conv,
+            COALESCE(product_ads.cost, 0) AS cost
+        FROM product_revenue
+        LEFT JOIN product_ads ON product_ads.target_page = '/products/' || product_revenue.handle
+        ORDER BY revenue DESC
+        """, [from_date, to_date, from_date, to_date]
+    ).df()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parquet snapshots and local DuckDB reports")
+    parser.add_argument('command', choices=['export', 'report'])
+    parser.add_argument('--from-date', type=date.fromisoformat, default=None, help="report start; for export, re-export from this day")
+    parser.add_argument('--to-date', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--tenant', default=None, help="tenant name from TENANTS")
+    args = parser.parse_args()
+
+    with use_tenant(get_tenant(args.tenant)):
+        if args.command == 'export':
+            export_snapshots(until=args.to_date, from_date=args.from_date)
+        else:
+            from_date = args.from_date or args.to_date - timedelta(days=90)
+            con = connect_snapshots()
+            print(ads_vs_revenue(con, from_date, args.to_date).to_string())
+            print(product_spend(con, from_date, args.to_date).to_string())
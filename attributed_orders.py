@@ -0,0 +1,56 @@
+from datetime import datetime
+from db import run_query
+
+ATTRIBUTED_ORDERS_PAGE_SIZE = 500
+
+def get_last_match_time():
+    row = run_query("SELECT MAX(matched_at) AS last_match FROM orders", fetch_one=True)
+    return row.get('last_match') if row else None
+
+def encode_cursor(order):
+    return f"{order['shopify_order_date'].isoformat()}_{order['shopify_order_id']}"
+
+def decode_cursor(cursor):
+    order_date, order_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(order_date), int(order_id)
+
+def query_attributed_orders(start_date=None, end_date=None, utm_source=None, after=None, limit=ATTRIBUTED_ORDERS_PAGE_SIZE):
+    # Keyset pagination on (shopify_order_date, shopify_order_id): every page is an index range scan
+    filters = ["ga_user_pseudo_id IS NOT NULL"]
+    params = []
+    if start_date:
+        filters.append("shopify_order_date >= %s")
+        params.append(start_date)
+    if end_date:
+        filters.append("shopify_order_date < %s::date + 1")
+        params.append(end_date)
+    if utm_source is not None:
+        filters.append("utm_source = %s")
+        params.append(utm_source)
+    if after:
+        filters.append("(shopify_order_date, shopify_order_id) > (%s, %s)")
+        params.extend(decode_cursor(after))
+
+    orders = run_query(
+        f"""
+        SELECT
+            shopify_order_id,
+            shopify_customer_id,
+            shopify_order_date,
+            shopify_order_total,
+            shopify_delivery_price,
+            ga_user_pseudo_id,
+            utm_source,
+            utm_medium,
+            utm_campaign,
+            utm_term,
+            matched_at
+        FROM orders
+        WHERE {' AND '.join(filters)}
+        ORDER BY shopify_order_date, shopify_order_id
+        LIMIT %s
+        """, (*params, limit), fetch_all=True
+    ) or []
+
+    next_cursor = encode_cursor(orders[-1]) if len(orders) == limit else None
+    return orders, next_cursor
@@ -0,0 +1,59 @@
+from db import run_query
+
+def rebuild_attribution_daily(start_date=None):
+    # Full recompute from orders; process_orders keeps the table current by delta afterwards.
+    # One transaction: readers keep seeing the old rollup until it commits, and the lock holds
+    # back concurrent match deltas until then, so none is lost or counted twice.
+    if start_date:
+        delete_line = "WHERE day >= %s"
+        date_line = "AND shopify_order_date >= %s"
+        params = (start_date, start_date)
+    else:
+        delete_line = ""
+        date_line = ""
+        params = ()
+
+    run_query(
+        f"""
+        LOCK TABLE attribution_daily IN EXCLUSIVE MODE;
+        DELETE FROM attribution_daily {delete_line};
+        INSERT INTO attribution_daily (day, utm_source, utm_medium, utm_campaign, utm_term, revenue, order_count)
+        SELECT
+            DATE(shopify_order_date),
+            COALESCE(utm_source, ''),
+            COALESCE(utm_medium, ''),
+            COALESCE(utm_campaign, ''),
+            COALESCE(utm_term, ''),
+            SUM(shopify_order_total),
+            COUNT(*)
+        FROM orders
+        WHERE ga_user_pseudo_id IS NOT NULL {date_line}
+        GROUP BY 1, 2, 3, 4, 5
+        """, params
+    )
+
+def query_attribution_daily(start_date, end_date, utm_source=None, utm_medium=None, utm_campaign=None):
+    filters = ["day BETWEEN %s AND %s"]
+    params = [start_date, end_date]
+    for column, value in (("utm_source", utm_source), ("utm_medium", utm_medium), ("utm_campaign", utm_campaign)):
+        if value is not None:
+            filters.append(f"{column} = %s")
+            params.append(value)
+
+    rows = run_query(
+        f"""
+        SELECT
+            day,
+            utm_source,
+            utm_medium,
+            utm_campaign,
+            utm_term,
+            revenue,
+            order_count,
+            ROUND(revenue / NULLIF(order_count, 0), 2) AS aov
+        FROM attribution_daily
+        WHERE {' AND '.join(filters)}
+        ORDER BY day, utm_source, utm_medium, utm_campaign, utm_term
+        """, tuple(params), fetch_all=True
+    )
+    return rows or []
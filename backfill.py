@@ -0,0 +1,106 @@
+import os, argparse, pytz
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from db import run_query
+from get_ga_db import query_ga_events, insert_ga_events, ga_daily_table
+from get_shopify_sessions import iter_orders_pages, sync_orders
+from tenants import current_tenant, use_tenant, get_tenant
+
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+SOURCES = ('ga', 'shopify')
+
+def get_done_shards(source, start_date, end_date):
+    rows = run_query(
+        """
+        SELECT shard_date FROM backfill_shards
+        WHERE source = %s AND shard_date BETWEEN %s AND %s AND status = 'done'
+        """, (source, start_date, end_date), fetch_all=True
+    ) or []
+    return {row['shard_date'] for row in rows}
+
+def checkpoint_shard(source, shard_date, status, row_count=None, error=None):
+    run_query(
+        """
+        INSERT INTO backfill_shards (source, shard_date, status, row_count, error, updated_at)
+        VALUES (%s, %s, %s, %s, %s, NOW())
+        ON CONFLICT (source, shard_date) DO UPDATE SET
+            status = EXCLUDED.status,
+            row_count = EXCLUDED.row_count,
+            error = EXCLUDED.error,
+            updated_at = EXCLUDED.updated_at
+        """, (source, shard_date, status, row_count, error)
+    )
+
+def _day_bounds_iso(day):
+    start = datetime.combine(day, time.min)
+    end = start + timedelta(days=1)
+    org_timezone = current_tenant()['org_timezone']
+    if org_timezone:
+        tz = pytz.timezone(org_timezone)
+        start, end = tz.localize(start), tz.localize(end)
+    return start.isoformat(), end.isoformat()
+
+def backfill_ga_shard(day):
+    events = query_ga_events(ga_daily_table(day))
+    if events is None:
+        raise RuntimeError("query skipped by BQ_MAXIMUM_BYTES_BILLED")
+    if events:
+        insert_ga_events(events)
+    return len(events)
+
+def backfill_shopify_shard(day):
+    created_at_min, created_at_max = _day_bounds_iso(day)
+    tenant = current_tenant()
+    return sync_orders(iter_orders_pages(tenant['shopify_api_key'], tenant['shopify_domain'], created_at_min, created_at_max))
+
+def run_shard(source, day):
+    checkpoint_shard(source, day, 'running')
+    try:
+        if source == 'ga':
+            row_count = backfill_ga_shard(day)
+        else:
+            row_count = backfill_shopify_shard(day)
+    except Exception as e:
+        print(f"[{source} {day}] failed: {e}")
+        checkpoint_shard(source, day, 'failed', error=str(e))
+        return False
+    checkpoint_shard(source, day, 'done', row_count=row_count)
+    print(f"[{source} {day}] done, {row_count} rows")
+    return True
+
+def backfill(start_date, end_date, sources=SOURCES, concurrency=None, restart=False):
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    shards = []
+    for source in sources:
+        done = set() if restart else get_done_shards(source, start_date, end_date)
+        shards.extend((source, day) for day in days if day not in done)
+
+    if not shards:
+        print("Nothing to backfill, all shards are done.")
+        return
+
+    print(f"Backfilling {len(shards)} shards with concurrency {concurrency or BACKFILL_CONCURRENCY}...")
+    tenant = current_tenant()
+    def run_tenant_shard(shard):
+        with use_tenant(tenant):
+            return run_shard(*shard)
+
+    with ThreadPoolExecutor(max_workers=concurrency or BACKFILL_CONCURRENCY) as executor:
+        results = list(executor.map(run_tenant_shard, shards))
+
+    failed = results.count(False)
+    print(f"Backfill finished: {len(results) - failed} done, {failed} failed. Re-run the same command to retry.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild ga_events and orders for a past date range")
+    parser.add_argument('--start', type=date.fromisoformat, required=True)
+    parser.add_argument('--end', type=date.fromisoformat, required=True)
+    parser.add_argument('--source', choices=['all', *SOURCES], default='all')
+    parser.add_argument('--concurrency', type=int, default=BACKFILL_CONCURRENCY)
+    parser.add_argument('--restart', action='store_true', help="ignore checkpoints and redo every shard")
+    parser.add_argument('--tenant', default=None, help="tenant name from TENANTS")
+    args = parser.parse_args()
+
+    sources = SOURCES if args.source == 'all' else (args.source,)
+    with use_tenant(get_tenant(args.tenant)):
+        backfill(args.start, args.end, sources, args.concurrency, args.restart)
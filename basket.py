@@ -0,0 +1,24 @@
+import hashlib
+from decimal import Decimal, ROUND_HALF_UP
+
+def to_cents(value):
+    # Goes through str() so 19.99 and Decimal('19.99') land on the same integer
+    return int((Decimal(str(value or 0)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def basket_signature(products, order_total, shipping_value):
+    # Canonical hash of sorted (item_id, price in cents, quantity) plus total and shipping in cents.
+    # Computed at ingest for both GA events and Shopify orders so matching is an equality lookup.
+    if not products:
+        return None
+
+    items = []
+    for product in products:
+        try:
+            item_id = int(product.get('item_id') or 0)
+        except (TypeError, ValueError):
+            item_id = 0
+        items.append((item_id, to_cents(product.get('price')), int(float(product.get('quantity') or 0))))
+
+    canonical = ";".join(f"{item_id}:{price}:{quantity}" for item_id, price, quantity in sorted(items))
+    canonical += f"|{to_cents(order_total)}|{to_cents(shipping_value)}"
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
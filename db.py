@@ -1,9 +1,22 @@
 import os
+import re
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import execute_values
-from psycopg2.errors import UniqueViolation, ForeignKeyViolation
+from psycopg2.extras import execute_values, NamedTupleCursor, RealDictCursor
+from psycopg2.errors import UniqueViolation, ForeignKeyViolation, CardinalityViolation
+from tenants import current_tenant
 
 def get_db_config():
+    options = f"endpoint={os.getenv('POSTGRESQL_ENDPOINT')}"
+    # Tenants with their own schema get it as the whole search_path, so every query stays
+    # unqualified and a missing table fails instead of reaching the single-store tables in public
+    db_schema = current_tenant().get('db_schema')
+    if db_schema:
+        options += f" -c search_path={db_schema}"
     return {
         "host": os.getenv("POSTGRESQL_HOST"),
         "database": os.getenv("POSTGRESQL_DATABASE"),
@@ -11,68 +24,202 @@ def get_db_config():
         "password": os.getenv("POSTGRESQL_PASSWORD"),
         "port": os.getenv("POSTGRESQL_PORT", 5432),
         "sslmode": "require",
-        "options": f"endpoint={os.getenv('POSTGRESQL_ENDPOINT')}"
+        "options": options
     }
 
 def get_conn():
     return psycopg2.connect(**get_db_config())
 
+# Connection pinned to the current thread by worker_connection(); run_query reuses it
+_worker = threading.local()
+
+@contextmanager
+def worker_connection():
+    conn = get_conn()
+    _worker.conn = conn
+    try:
+        yield conn
+    finally:
+        _worker.conn = None
+        conn.close()
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 1000))
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', '').lower() in ('1', 'true', 'yes')
+EXPLAINABLE_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+def _param_shape(params):
+    # Types and sizes only, never values
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {_param_shape(v)}" for k, v in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        if len(params) > 5:
+            return f"{type(params).__name__}[{len(params)}]"
+        return "(" + ", ".join(_param_shape(p) if isinstance(p, (list, tuple, dict)) else type(p).__name__ for p in params) + ")"
+    return type(params).__name__
+
+def _log_slow_query(cur, query, params, elapsed_ms, row_count):
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+    statement = " ".join(query.split())
+    print(f"SLOW QUERY {elapsed_ms:.0f}ms rows={row_count} params={_param_shape(params)}: {statement[:300]}")
+
+    # EXPLAIN ANALYZE executes the statement again; it runs under a savepoint that is rolled back,
+    # so slow UPDATE/INSERT/DELETE CTEs can be explained without applying them twice
+    explainable = statement.split(None, 1)[0].upper() in EXPLAINABLE_STATEMENTS and ';' not in statement.rstrip('; ')
+    if SLOW_QUERY_EXPLAIN and cur is not None and explainable:
+        cur.execute("SAVEPOINT slow_query_explain")
+        try:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params or ())
+            print("\n".join(line[0] for line in cur.fetchall()))
+        except Exception as e:
+            print(f"EXPLAIN failed: {e}")
+        finally:
+            cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            cur.execute("RELEASE SAVEPOINT slow_query_explain")
 
 def run_query(query, params=None, fetch_one=False, fetch_all=False):
+    worker_conn = getattr(_worker, 'conn', None)
+    conn = None
     try:
-        with get_conn() as conn:
+        conn = worker_conn or get_conn()
+        with conn:
             with conn.cursor() as cur:
+                started = time.monotonic()
                 cur.execute(query, params or ())
+                result = None
 
                 if fetch_one:
                     row = cur.fetchone()
-                    if not row:
-                        return None
-                    cols = [desc[0] for desc in cur.description]
-                    return dict(zip(cols, row))
-
-                if fetch_all:
+                    if row:
+                        cols = [desc[0] for desc in cur.description]
+                        result = dict(zip(cols, row))
+                elif fetch_all:
                     rows = cur.fetchall()
                     cols = [desc[0] for desc in cur.description]
-                    return [dict(zip(cols, r)) for r in rows]
+                    result = [dict(zip(cols, r)) for r in rows]
+                else:
+                    conn.commit()
 
-                conn.commit()
-                return None
+                _log_slow_query(cur, query, params, (time.monotonic() - started) * 1000, cur.rowcount)
+                return result
     except UniqueViolation:
         raise ValueError(f"Already exists")
     except ForeignKeyViolation:
         raise ValueError(f"Invalid foreign key")
     except Exception as e:
         raise RuntimeError(f"Failed to insert: {str(e)}")
+    finally:
+        if conn and not worker_conn:
+            conn.close()
+
+STREAM_ITERSIZE = int(os.getenv('STREAM_ITERSIZE', 2000))
+ROW_CURSOR_FACTORIES = {
+    "tuple": None,
+    "namedtuple": NamedTupleCursor,
+    "dict": RealDictCursor
+}
+
+def stream_query(query, params=None, row_format="dict", itersize=None):
+    # Server-side named cursor: rows arrive in batches of itersize, so memory stays flat
+    # no matter how large the result is. Consume the generator fully or close() it.
+    if row_format not in ROW_CURSOR_FACTORIES:
+        raise ValueError(f"Unknown row format: {row_format}")
+
+    worker_conn = getattr(_worker, 'conn', None)
+    conn = worker_conn or get_conn()
+    try:
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=ROW_CURSOR_FACTORIES[row_format]) as cur:
+            cur.itersize = itersize or STREAM_ITERSIZE
+            cur.execute(query, params or ())
+            for row in cur:
+                yield row
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise RuntimeError(f"Failed to stream query: {str(e)}")
+    finally:
+        if not worker_conn:
+            conn.close()
+
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 5000))
+
+def _bulk_target(query):
+    target = re.search(r'\b(?:INSERT\s+INTO|UPDATE)\s+([\w.]+)', query, re.IGNORECASE)
+    return target.group(1) if target else None
+
+def _quarantine_row(cur, target, row, error):
+    cur.execute(
+        """
+        INSERT INTO dead_letter_rows (target_table, row_data, error)
+        VALUES (%s, %s, %s)
+        """,
+        (target, json.dumps(row, default=str), str(error).strip())
+    )
+
+# Errors a single row (or a pair of duplicate keys in one ON CONFLICT DO UPDATE batch) can cause;
+# anything else aborts the whole write
+QUARANTINABLE_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, CardinalityViolation)
+
+def _write_rows(cur, query, rows, page_size, target):
+    # Writes rows under a savepoint; on a data error splits the batch in halves until the
+    # offending rows are isolated and moved to dead_letter_rows.
+    # Returns (written, quarantined, affected) where affected is what Postgres reports as changed.
+    cur.execute("SAVEPOINT bulk_rows")
+    try:
+        affected = 0
+        for start in range(0, len(rows), page_size):
+            execute_values(cur, query, rows[start:start + page_size], page_size=page_size)
+            affected += max(cur.rowcount, 0)
+        cur.execute("RELEASE SAVEPOINT bulk_rows")
+        return len(rows), 0, affected
+    except QUARANTINABLE_ERRORS as error:
+        cur.execute("ROLLBACK TO SAVEPOINT bulk_rows")
+        cur.execute("RELEASE SAVEPOINT bulk_rows")
+        if len(rows) == 1:
+            print(f"Quarantining row for {target}: {error}")
+            _quarantine_row(cur, target, rows[0], error)
+            return 0, 1, 0
+
+    middle = len(rows) // 2
+    left = _write_rows(cur, query, rows[:middle], page_size, target)
+    right = _write_rows(cur, query, rows[middle:], page_size, target)
+    return left[0] + right[0], left[1] + right[1], left[2] + right[2]
 
-def run_many_query(query: str, data: list, page_size=1000):
+def run_many_query(query: str, data: list, page_size=1000, chunk_size=None):
+    # Commits every chunk_size rows; a bad row only costs a bisect of its own chunk.
+    # Returns counts for committed chunks only; any other error rolls back the current chunk and raises.
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    target = _bulk_target(query)
+    written = 0
+    quarantined = 0
+    affected = 0
     conn = None
     try:
         conn = get_conn()
         with conn.cursor() as cur:
             print(f"Preparing to insert {len(data)} rows using execute_values...")
-            execute_values(
-                cur,
-                query,
-                data,
-                page_size=page_size
-            )
-            conn.commit()
-            print(f"Successfully inserted {len(data)} rows.")
-            
-    except UniqueViolation:
-        print("Database error: Record already exists (UniqueViolation).")
-        if conn:
-            conn.rollback()
-    except ForeignKeyViolation:
-        print("Database error: Invalid foreign key.")
-        if conn:
-            conn.rollback()
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start:start + chunk_size]
+                started = time.monotonic()
+                chunk_written, chunk_quarantined, chunk_affected = _write_rows(cur, query, chunk, page_size, target)
+                conn.commit()
+                _log_slow_query(None, query, chunk, (time.monotonic() - started) * 1000, chunk_affected)
+                written += chunk_written
+                quarantined += chunk_quarantined
+                affected += chunk_affected
+            print(f"Successfully inserted {written} rows, quarantined {quarantined}.")
+
     except Exception as error:
-        print(f"An unexpected database error occurred: {error}")
         if conn:
             conn.rollback()
+        raise RuntimeError(
+            f"Bulk write to {target} failed after {written} rows committed, {quarantined} quarantined: {error}"
+        ) from error
     finally:
         if conn:
             conn.close()
-            print("Database connection closed.")
\ No newline at end of file
+            print("Database connection closed.")
+
+    return {"written": written, "quarantined": quarantined, "affected": affected}
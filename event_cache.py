@@ -0,0 +1,265 @@
+import os, threading
+from datetime import datetime, timedelta
+import pytz
+from basket import to_cents
+from db import run_query, stream_query
+from tenants import current_tenant
+
+# Process-level cache of recent funnel and UTM events, so warm invocations can match without
+# going back to Postgres. Bounded by event age and by an approximate memory budget.
+# Other instances and backfills write ga_events too, so the cache is only trusted for days it
+# holds completely: refresh_event_cache() checks per-day counts against Postgres for the days a
+# matching run actually needs, once orders were claimed, and reloads the days that differ.
+EVENT_CACHE_ENABLED = os.getenv('EVENT_CACHE_ENABLED', '1') == '1'
+EVENT_CACHE_HOURS = int(os.getenv('EVENT_CACHE_HOURS', 72))
+EVENT_CACHE_MAX_BYTES = int(os.getenv('EVENT_CACHE_MAX_MB', 64)) * 1024 ** 2
+
+FUNNEL_EVENTS = ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
+
+# Rough per-entry footprint, used for the memory budget only
+_ENTRY_BYTES = 600
+_PRODUCT_BYTES = 120
+
+# Rows the cache holds, as a WHERE clause over ga_events
+_CACHED_EVENTS_FILTER = "(event_name IN %s OR utm_source IS NOT NULL)"
+
+def _product_key(product):
+    try:
+        item_id = int(product.get('item_id') or 0)
+    except (TypeError, ValueError):
+        item_id = 0
+    return (item_id, to_cents(product.get('price')), int(float(product.get('quantity') or 0)))
+
+class EventCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}       # (ga_user_pseudo_id, event_timestamp) -> entry
+        self.by_day = {}        # date -> set of keys
+        self.by_total = {}      # order_total in cents -> set of keys (funnel events)
+        self.by_pseudo_id = {}  # ga_user_pseudo_id -> set of keys (events with UTMs)
+        self.covered_days = set()  # days known to match ga_events exactly
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, event):
+        is_funnel = event['event_name'] in FUNNEL_EVENTS
+        if not is_funnel and event.get('utm_source') is None:
+            return
+        key = (event['ga_user_pseudo_id'], event['event_timestamp'])
+        if key in self.entries:
+            # Same key as the ga_events conflict target: the first version wins, as in Postgres
+            return
+        params = event.get('event_params') or {}
+        entry = {
+            "ga_user_pseudo_id": event['ga_user_pseudo_id'],
+            "event_name": event['event_name'],
+            "event_timestamp": event['event_timestamp'],
+            "utm_source": event.get('utm_source'),
+            "utm_campaign": event.get('utm_campaign'),
+            "utm_medium": event.get('utm_medium'),
+            "utm_term": event.get('utm_term'),
+            "basket_signature": event.get('basket_signature'),
+            "total_cents": None,
+            "shipping_cents": None,
+            "products": ()
+        }
+        if is_funnel:
+            entry['total_cents'] = to_cents(params.get('order_total'))
+            entry['shipping_cents'] = to_cents(params.get('shipping_value'))
+            entry['products'] = tuple(_product_key(p) for p in params.get('products') or [])
+            self.by_total.setdefault(entry['total_cents'], set()).add(key)
+        if entry['utm_source'] is not None:
+            self.by_pseudo_id.setdefault(entry['ga_user_pseudo_id'], set()).add(key)
+
+        self.entries[key] = entry
+        self.by_day.setdefault(entry['event_timestamp'].date(), set()).add(key)
+        self.size += _ENTRY_BYTES + _PRODUCT_BYTES * len(entry['products'])
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        # A day that lost an entry is no longer complete
+        self.covered_days.discard(entry['event_timestamp'].date())
+        for index, index_key in (
+            (self.by_day, entry['event_timestamp'].date()),
+            (self.by_total, entry['total_cents']),
+            (self.by_pseudo_id, entry['ga_user_pseudo_id'])
+        ):
+            keys = index.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[index_key]
+        self.size -= _ENTRY_BYTES + _PRODUCT_BYTES * len(entry['products'])
+
+    def drop_day(self, day):
+        for key in list(self.by_day.get(day, ())):
+            self.remove(key)
+        self.covered_days.discard(day)
+
+    def evict(self, now):
+        # Whole days past the horizon first, then the oldest events until the memory budget fits
+        cutoff = now - timedelta(hours=EVENT_CACHE_HOURS)
+        for day in sorted(self.by_day):
+            if day >= cutoff.date():
+                break
+            self.drop_day(day)
+        for key in [key for key in self.by_day.get(cutoff.date(), ()) if key[1] < cutoff]:
+            self.remove(key)
+        self.covered_days = {day for day in self.covered_days if day >= cutoff.date()}
+
+        while self.size > EVENT_CACHE_MAX_BYTES and self.by_day:
+            oldest_day = min(self.by_day)
+            for key in sorted(self.by_day[oldest_day], key=lambda k: k[1]):
+                self.remove(key)
+                if self.size <= EVENT_CACHE_MAX_BYTES:
+                    break
+
+    def covers(self, start_date, end_date):
+        return all(start_date + timedelta(days=i) in self.covered_days for i in range((end_date - start_date).days))
+
+    def covered_from(self, last_day):
+        # First day of the unbroken run of covered days ending at last_day, or None
+        if last_day not in self.covered_days:
+            return None
+        day = last_day
+        while day - timedelta(days=1) in self.covered_days:
+            day -= timedelta(days=1)
+        return day
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _tenant_cache():
+    name = current_tenant()['name']
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = EventCache()
+        return _caches[name]
+
+def _tenant_now():
+    # ga_events.event_timestamp holds the tenant's local wall time
+    return datetime.now(pytz.timezone(current_tenant()['org_timezone'])).replace(tzinfo=None)
+
+def remember_events(events):
+    # events: ga_events rows whose write has committed (column names as keys, event_timestamp
+    # as a naive local datetime). Adding them keeps a covered day covered.
+    if not EVENT_CACHE_ENABLED or not events:
+        return
+    cache = _tenant_cache()
+    now = _tenant_now()
+    cutoff = now - timedelta(hours=EVENT_CACHE_HOURS)
+    with cache.lock:
+        for event in events:
+            if event['event_timestamp'] >= cutoff:
+                cache.add(event)
+        cache.evict(now)
+
+def refresh_event_cache(start_date, end_date):
+    # Compares per-day counts of cacheable events with Postgres for the whole days of
+    # [start_date, end_date) inside the cache horizon (tomorrow included, which has to be empty)
+    # and reloads each day that differs. Only these days are covered afterwards: coverage from an
+    # earlier run may be stale, so lookups on any other day go to Postgres.
+    if not EVENT_CACHE_ENABLED:
+        return
+    cache = _tenant_cache()
+    now = _tenant_now()
+    first_day = max(start_date, (now - timedelta(hours=EVENT_CACHE_HOURS)).date() + timedelta(days=1))
+    end_day = min(end_date, now.date() + timedelta(days=2))
+    with cache.lock:
+        cache.covered_days.clear()
+    if first_day >= end_day:
+        return
+
+    rows = run_query(
+        f"""
+        SELECT DATE(event_timestamp) AS day, COUNT(*) AS events
+        FROM ga_events
+        WHERE event_timestamp >= %s AND event_timestamp < %s AND {_CACHED_EVENTS_FILTER}
+        GROUP BY DATE(event_timestamp)
+        """, (first_day, end_day, FUNNEL_EVENTS), fetch_all=True
+    ) or []
+    db_counts = {row['day']: row['events'] for row in rows}
+
+    days = [first_day + timedelta(days=i) for i in range((end_day - first_day).days)]
+    with cache.lock:
+        stale = [day for day in days if db_counts.get(day, 0) != len(cache.by_day.get(day, ()))]
+        for day in days:
+            if day not in stale:
+                cache.covered_days.add(day)
+
+    for day in stale:
+        events = list(stream_query(
+            f"""
+            SELECT ga_user_pseudo_id, event_name, event_timestamp, utm_source, utm_campaign,
+                utm_medium, utm_term, event_params, basket_signature
+            FROM ga_events
+            WHERE event_timestamp >= %s AND event_timestamp < %s AND {_CACHED_EVENTS_FILTER}
+            """, (day, day + timedelta(days=1), FUNNEL_EVENTS), row_format="dict"
+        ))
+        with cache.lock:
+            cache.drop_day(day)
+            for event in events:
+                cache.add(event)
+            cache.covered_days.add(day)
+            cache.evict(now)
+    if stale:
+        print(f"Event cache: reloaded {len(stale)} day(s) from ga_events")
+
+def find_cached_purchases(start_date, end_date, order_total, delivery_price, products, signature):
+    # Funnel events in [start_date, end_date) for this basket: signature matches first, then the
+    # same total/shipping/product containment test as the SQL fallback. Returns None when the
+    # window isn't fully covered, so the caller asks Postgres instead.
+    if not EVENT_CACHE_ENABLED:
+        return None
+    cache = _tenant_cache()
+    total_cents = to_cents(order_total)
+    shipping_cents = to_cents(delivery_price)
+    wanted = [_product_key(p) for p in products or []]
+
+    with cache.lock:
+        if not cache.covers(start_date, end_date):
+            cache.misses += 1
+            return None
+        cache.hits += 1
+        candidates = [
+            cache.entries[key] for key in cache.by_total.get(total_cents, ())
+            if start_date <= key[1].date() < end_date
+        ]
+        purchases = [entry for entry in candidates if signature and entry['basket_signature'] == signature]
+        if not purchases:
+            purchases = [
+                entry for entry in candidates
+                if entry['shipping_cents'] == shipping_cents and all(product in entry['products'] for product in wanted)
+            ]
+    return [dict(entry) for entry in purchases]
+
+def cached_last_touch_events(pseudo_id, is_referral, before):
+    # Same filter and order as get_last_events_by_pseudo_id. Only answers when the latest touch
+    # before `before` lies in the unbroken covered run up to that day, so nothing closer can be
+    # missing; returns None otherwise.
+    if not EVENT_CACHE_ENABLED:
+        return None
+    cache = _tenant_cache()
+    with cache.lock:
+        covered_from = cache.covered_from(before.date())
+        events = [
+            dict(cache.entries[key]) for key in cache.by_pseudo_id.get(pseudo_id, ())
+            if is_referral or (cache.entries[key]['utm_campaign'] is not None and cache.entries[key]['utm_campaign'] != '(referral)')
+        ]
+        if covered_from is None or not any(covered_from <= event['event_timestamp'].date() and event['event_timestamp'] < before for event in events):
+            cache.misses += 1
+            return None
+        cache.hits += 1
+    return sorted(events, key=lambda event: event['event_timestamp'], reverse=True)
+
+def event_cache_stats():
+    cache = _tenant_cache()
+    with cache.lock:
+        return {
+            "events": len(cache.entries),
+            "covered_days": len(cache.covered_days),
+            "approx_bytes": cache.size,
+            "hits": cache.hits,
+            "misses": cache.misses
+        }
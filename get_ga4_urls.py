@@ -1,8 +1,10 @@
-import os, re, json
+import os, re, json, argparse
 from urllib.parse import urlparse, parse_qs, urlunparse
-from datetime import date
+from datetime import date, timedelta
 import pandas as pd
-from get_shopify_sessions import get_orders_data, get_products_by_ids
+from db import run_query, run_many_query
+from tenants import current_tenant, use_tenant, get_tenant
+from get_shopify_sessions import get_orders_data, get_products_by_ids, get_product_handles_cached, parse_landing_site_url
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -102,35 +104,6 @@ def ads_raw_report_to_df(raw_path='ads_url_report.csv'):
         except Exception as e:
             print(f"Error on report saving: {e}")
 
-def parse_landing_site_url(url_string):
-    parsed_url = urlparse(url_string)
-    query_params = parse_qs(parsed_url.query)
-
-    utm_source = query_params.get('utm_source', [None])[0]
-    utm_medium = query_params.get('utm_medium', [None])[0]
-    utm_campaign = query_params.get('utm_campaign', [None])[0]
-    utm_content = query_params.get('utm_content', [None])[0]
-    utm_term = query_params.get('utm_term', [None])[0]
-    gad_campaignid = query_params.get('gad_campaignid', [None])[0]
-    gbraid = query_params.get('gbraid', [None])[0]
-    gclid = query_params.get('gclid', [None])[0]
-
-    target_page = parsed_url.path
-    final_target_page = re.sub(r'[^a-zA-Z0-9/\-]', '', target_page)
-
-    return {
-        "utm_source": utm_source,
-        "utm_medium": utm_medium,
-        "utm_campaign": utm_campaign,
-        "utm_content": utm_content,
-        "utm_term": utm_term,
-        "gad_campaignid": gad_campaignid,
-        "gbraid": gbraid,
-        "gclid": gclid,
-        "path": target_page,
-        "target_page": final_target_page
-    }
-
 def match_gad_target_page_slices_with_ga_events(ads_df, ga_df):
     if 'metrics.clicks' not in ads_df.columns:
         print("ads_df is missing the 'metrics.clicks' column.")
@@ -290,17 +263,18 @@ def summarize_by_urls(products_urls_df):
 
     return products
 
-def summarize_all(final_report_df, orders):
-    product_revenue = {}
-    for order in orders:
-        for product in order.get('products', []):
-            handle = product.get('handle')
-            net_revenue = product.get('price', 0.0)
-            if handle:
-                product_data = product_revenue.get(handle, {"revenue": 0.0, "price": net_revenue})
+def summarize_all(final_report_df, orders, product_revenue=None):
+    if product_revenue is None:
+        product_revenue = {}
+        for order in orders:
+            for product in order.get('products', []):
+                handle = product.get('handle')
+                net_revenue = product.get('price', 0.0)
+                if handle:
+                    product_data = product_revenue.get(handle, {"revenue": 0.0, "price": net_revenue})
 
-                product_data["revenue"] += net_revenue
-                product_revenue[handle] = product_data
+                    product_data["revenue"] += net_revenue
+                    product_revenue[handle] = product_data
 
     product_revenue_spend_metrics = get_product_ad_spend(final_report_df, product_revenue)
     core_products_to_scale_urls = {
@@ -338,58 +312,271 @@ def summarize_all(final_report_df, orders):
 
     return core_products_to_scale, brilliant_urls, wasting_urls, final_report_totals
 
-if __name__ == '__main__':
-    from_date = date(2025, 8, 16)
-    orders_data = get_orders_data(os.getenv("SHOPIFY_API_KEY"), os.getenv("SHOPIFY_DOMAIN"), from_date.isoformat())
+def load_google_orders_from_shopify(from_date):
+    tenant = current_tenant()
+    orders_data = get_orders_data(tenant['shopify_api_key'], tenant['shopify_domain'], from_date.isoformat())
 
     orders = []
-    products_dict = {}
     if orders_data:
         for order in orders_data:
             params = parse_landing_site_url(order.get('landingSite'))
             params['products'] = order['products']
-            for product in order['products']:
-                products_dict[product['item_id']] = ''
             params['net_revenue'] = sum(float(item.get('price', 0)) * float(item.get('quantity', 0)) for item in order['products'])
             if params.get('utm_source') == 'google':
                 orders.append(params)
+    return orders
+
+def count_google_orders_in_db(from_date, to_date=None):
+    # The DB report reads revenue straight from orders and order_items; this only checks there is
+    # something to report, and warns about orders it can't attribute
+    to_date = to_date or date.today()
+    counts = run_query(
+        """
+        SELECT
+            COUNT(*) FILTER (WHERE landing_utm_source = 'google') AS google_orders,
+            COUNT(*) FILTER (WHERE landing_site IS NULL) AS missing_landing
+        FROM orders
+        WHERE shopify_order_date >= %s AND shopify_order_date < %s
+        """, (from_date, to_date + timedelta(days=1)), fetch_one=True
+    ) or {}
+    if counts.get('missing_landing'):
+        # Either synced before the landing columns existed or without a landing site in Shopify
+        print(
+            f"WARNING: {counts['missing_landing']} orders since {from_date} have no landing data and are left out; "
+            f"re-sync them with backfill.py --source shopify (see README)"
+        )
+    return counts.get('google_orders') or 0
+
+def query_product_revenue(from_date, to_date=None):
+    # Same figures summarize_all builds from the order list, as one aggregation over order_items
+    to_date = to_date or date.today()
+    rows = run_query(
+        """
+        SELECT
+            order_items.item_id,
+            SUM(order_items.price) AS revenue,
+            (ARRAY_AGG(order_items.price ORDER BY order_items.shopify_order_date, order_items.shopify_order_id))[1] AS price
+        FROM order_items
+        JOIN orders ON orders.shopify_order_id = order_items.shopify_order_id
+        WHERE order_items.shopify_order_date >= %s AND order_items.shopify_order_date < %s
+            AND orders.landing_utm_source = 'google'
+        GROUP BY order_items.item_id
+        """, (from_date, to_date + timedelta(days=1)), fetch_all=True
+    ) or []
+
+    handles = get_product_handles_cached({row['item_id']: '' for row in rows})
+    product_revenue = {}
+    for row in rows:
+        handle = handles.get(row['item_id'])
+        if handle:
+            product_revenue[handle] = {"revenue": float(row['revenue']), "price": float(row['price'])}
+    return product_revenue
 
-    products_with_handles = get_products_by_ids(products_dict)
-    for order in orders:
-        for product in order['products']:
-            item_id = product.get('item_id')
-            if item_id:
-                product['handle'] = products_with_handles.get(item_id)
-
-    ads_df = ads_raw_report_to_df('ads_url_report.csv')
-    if not ads_df.empty and orders:
-        final_report_df = match_and_aggregate_revenue(ads_df, orders)
-
-        final_report_df.rename(columns={
-            'gad_campaignid': 'gad',
-            'metrics.impressions': 'imp',
-            'metrics.clicks': 'click',
-            'metrics.cost': 'cost',
-            'total_revenue': 'rev',
-            'total_purchases': 'conv'
-        }, inplace=True)
-        final_report_df.drop(columns=['metrics.conversions'], inplace=True)
-
-        add_comment_column(final_report_df)        
-
-        core_products_to_scale, brilliant_urls, wasting_urls, final_report_totals = summarize_all(final_report_df, orders)
-
-        print("Products that have purchases and perform well, but have poor or none direct traffic")
-        print(json.dumps(core_products_to_scale, indent=2))
-        print("Products with brilliant performance")
-        print(json.dumps(brilliant_urls, indent=2))
-        print("Products with poor performance")
-        print(json.dumps(wasting_urls, indent=2))
-        print("Total values")
-        print(json.dumps(final_report_totals, indent=2))
-
-        # output_file_name = 'final_ads_ga4_report.xlsx'
-        # final_report_df.to_excel(output_file_name, index=False)
-        # print(f"Report saved: {output_file_name}")
-    else:
-        print("No Ads data or Google-sourced orders found.")
+def ingest_ads_metrics(raw_path='ads_url_report.csv'):
+    # Incremental load of the raw Ads landing-page report: days before the last loaded one are skipped,
+    # the last loaded day is re-upserted since the export may have caught it mid-day
+    ads_df = load_ads_data(raw_path)
+    required_columns = ['segments.date', 'campaign.name', 'expanded_landing_page_view.expanded_final_url', 'metrics.impressions', 'metrics.clicks', 'metrics.conversions', 'metrics.cost_micros']
+    if ads_df is None or not all(col in ads_df.columns for col in required_columns):
+        print('missing cols')
+        return 0
+
+    ads_df['segments.date'] = pd.to_datetime(ads_df['segments.date'], errors='coerce').dt.date
+    ads_df = ads_df.dropna(subset=['segments.date', 'expanded_landing_page_view.expanded_final_url'])
+
+    last_day = run_query("SELECT MAX(segment_date) AS last_day FROM ads_metrics", fetch_one=True).get('last_day')
+    if last_day:
+        ads_df = ads_df[ads_df['segments.date'] >= last_day]
+    if ads_df.empty:
+        print("No new Ads days to ingest.")
+        return 0
+
+    for col in ['metrics.impressions', 'metrics.clicks', 'metrics.conversions', 'metrics.cost_micros']:
+        ads_df[col] = pd.to_numeric(ads_df[col], errors='coerce').fillna(0)
+
+    # One row per date, campaign and final URL, as in the table's primary key
+    ads_df = ads_df.groupby(['segments.date', 'campaign.name', 'expanded_landing_page_view.expanded_final_url']).agg({
+        'metrics.impressions': 'sum',
+        'metrics.clicks': 'sum',
+        'metrics.conversions': 'sum',
+        'metrics.cost_micros': 'sum'
+    }).reset_index()
+
+    rows = []
+    for row in ads_df.itertuples(index=False):
+        final_url = row[2]
+        rows.append((
+            row[0],
+            row[1],
+            final_url,
+            extract_gad_campaignid(final_url),
+            get_target_page(clean_url(final_url)),
+            int(row[3]),
+            int(row[4]),
+            float(row[5]),
+            int(row[6])
+        ))
+
+    run_many_query(
+        """
+        INSERT INTO ads_metrics (
+            segment_date, campaign, final_url, gad_campaignid, target_page,
+            impressions, clicks, conversions, cost_micros
+        )
+        VALUES %s
+        ON CONFLICT (segment_date, campaign, final_url) DO UPDATE SET
+            impressions = EXCLUDED.impressions,
+            clicks = EXCLUDED.clicks,
+            conversions = EXCLUDED.conversions,
+            cost_micros = EXCLUDED.cost_micros
+        """, rows
+    )
+    return len(rows)
+
+def query_ads_revenue(from_date, to_date=None):
+    # SQL version of ads_raw_report_to_df + match_and_aggregate_revenue over the requested window only.
+    # Like the pandas path, rows without a target page or gad_campaignid are dropped, and each
+    # (target_page, gad_campaignid) key's revenue is credited to one row only (the one with the most
+    # impressions) even when several campaign names share the key.
+    to_date = to_date or date.today()
+    rows = run_query(
+        """
+        WITH ads AS (
+            SELECT
+                target_page,
+                gad_campaignid,
+                campaign,
+                SUM(impressions) AS impressions,
+                SUM(clicks) AS clicks,
+                SUM(conversions) AS conversions,
+                SUM(cost_micros) / 1000000.0 AS cost
+            FROM ads_metrics
+            WHERE segment_date BETWEEN %s AND %s
+                AND target_page IS NOT NULL AND gad_campaignid IS NOT NULL
+            GROUP BY target_page, gad_campaignid, campaign
+        ),
+        ranked_ads AS (
+            SELECT
+                ads.*,
+                ROW_NUMBER() OVER (
+                    PARTITION BY target_page, gad_campaignid
+                    ORDER BY impressions DESC, campaign
+                ) AS key_rank
+            FROM ads
+        ),
+        revenue AS (
+            SELECT
+                target_page,
+                gad_campaignid,
+                SUM(shopify_order_total - shopify_delivery_price) AS total_revenue,
+                COUNT(*) AS total_purchases
+            FROM orders
+            WHERE shopify_order_date >= %s AND shopify_order_date < %s
+                AND landing_utm_source = 'google'
+            GROUP BY target_page, gad_campaignid
+        )
+        SELECT
+            ranked_ads.target_page,
+            ranked_ads.gad_campaignid,
+            ranked_ads.campaign,
+            ranked_ads.impressions,
+            ranked_ads.clicks,
+            ranked_ads.conversions,
+            ranked_ads.cost,
+            COALESCE(revenue.total_revenue, 0) AS total_revenue,
+            COALESCE(revenue.total_purchases, 0) AS total_purchases
+        FROM ranked_ads
+        LEFT JOIN revenue
+            ON revenue.target_page = ranked_ads.target_page
+            AND revenue.gad_campaignid = ranked_ads.gad_campaignid
+            AND ranked_ads.key_rank = 1
+        ORDER BY ranked_ads.impressions DESC
+        """, (from_date, to_date, from_date, to_date + timedelta(days=1)), fetch_all=True
+    ) or []
+
+    report_df = pd.DataFrame(rows, columns=[
+        'target_page', 'gad_campaignid', 'campaign', 'impressions', 'clicks', 'conversions', 'cost', 'total_revenue', 'total_purchases'
+    ])
+    report_df = report_df.rename(columns={
+        'impressions': 'metrics.impressions',
+        'clicks': 'metrics.clicks',
+        'conversions': 'metrics.conversions',
+        'cost': 'metrics.cost'
+    })
+    # SUM() comes back as Decimal
+    for col in ['metrics.cost', 'total_revenue', 'metrics.conversions']:
+        report_df[col] = report_df[col].astype(float)
+    for col in ['metrics.impressions', 'metrics.clicks', 'total_purchases']:
+        report_df[col] = report_df[col].astype('int64')
+    return report_df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ads vs revenue report")
+    parser.add_argument('--source', choices=['db', 'shopify'], default='db', help="read orders from Postgres or the live Shopify API")
+    parser.add_argument('--from-date', type=date.fromisoformat, default=date(2025, 8, 16))
+    parser.add_argument('--ingest-ads', metavar='CSV', help="upsert new days of the raw Ads report into ads_metrics first")
+    parser.add_argument('--tenant', default=None, help="tenant name from TENANTS")
+    args = parser.parse_args()
+
+    with use_tenant(get_tenant(args.tenant)):
+        if args.ingest_ads:
+            print(f"Ingested {ingest_ads_metrics(args.ingest_ads)} Ads rows")
+
+        if args.source == 'db':
+            # Revenue comes from query_ads_revenue and query_product_revenue, not from an order list
+            orders = []
+            has_orders = count_google_orders_in_db(args.from_date) > 0
+            ads_df = query_ads_revenue(args.from_date)
+        else:
+            orders = load_google_orders_from_shopify(args.from_date)
+            has_orders = bool(orders)
+
+            products_dict = {}
+            for order in orders:
+                for product in order['products']:
+                    products_dict[product['item_id']] = ''
+
+            products_with_handles = get_products_by_ids(products_dict)
+            for order in orders:
+                for product in order['products']:
+                    item_id = product.get('item_id')
+                    if item_id:
+                        product['handle'] = products_with_handles.get(item_id)
+
+            ads_df = ads_raw_report_to_df('ads_url_report.csv')
+
+        if not ads_df.empty and has_orders:
+            if args.source == 'db':
+                final_report_df = ads_df
+            else:
+                final_report_df = match_and_aggregate_revenue(ads_df, orders)
+
+            final_report_df.rename(columns={
+                'gad_campaignid': 'gad',
+                'metrics.impressions': 'imp',
+                'metrics.clicks': 'click',
+                'metrics.cost': 'cost',
+                'total_revenue': 'rev',
+                'total_purchases': 'conv'
+            }, inplace=True)
+            final_report_df.drop(columns=['metrics.conversions'], inplace=True)
+
+            add_comment_column(final_report_df)        
+
+            product_revenue = query_product_revenue(args.from_date) if args.source == 'db' else None
+            core_products_to_scale, brilliant_urls, wasting_urls, final_report_totals = summarize_all(final_report_df, orders, product_revenue)
+
+            print("Products that have purchases and perform well, but have poor or none direct traffic")
+            print(json.dumps(core_products_to_scale, indent=2))
+            print("Products with brilliant performance")
+            print(json.dumps(brilliant_urls, indent=2))
+            print("Products with poor performance")
+            print(json.dumps(wasting_urls, indent=2))
+            print("Total values")
+            print(json.dumps(final_report_totals, indent=2))
+
+            # output_file_name = 'final_ads_ga4_report.xlsx'
+            # final_report_df.to_excel(output_file_name, index=False)
+            # print(f"Report saved: {output_file_name}")
+        else:
+            print("No Ads data or Google-sourced orders found.")
@@ -1,11 +1,24 @@
-import os, json, pytz
-from datetime import datetime, timezone
+import os, re, json, pytz
+from datetime import datetime, timezone, timedelta, date
 from google.oauth2.service_account import Credentials
 from google.cloud import bigquery
-from db import run_many_query
+from google.api_core.exceptions import NotFound
+from db import run_query, run_many_query
+from basket import basket_signature
+from tenants import current_tenant
+from event_cache import remember_events
+from pipeline_state import deadline_passed, get_cursor, save_cursor
 
-GA_EVENTS_TABLE = os.getenv('GA_EVENTS_TABLE')
-ORG_TIMEZONE = os.getenv('ORG_TIMEZONE')
+# ga_events is range-partitioned by month on event_timestamp (see README)
+GA_EVENTS_PARTITIONS_AHEAD = int(os.getenv('GA_EVENTS_PARTITIONS_AHEAD', 2))
+ATTRIBUTION_HORIZON_DAYS = int(os.getenv('ATTRIBUTION_HORIZON_DAYS', 180))
+GA_EVENTS_RETENTION_ACTION = os.getenv('GA_EVENTS_RETENTION_ACTION', 'drop')  # 'drop' or 'detach'
+# Hard cap per BigQuery job; a dry run above it skips the query instead of billing it
+BQ_MAXIMUM_BYTES_BILLED = int(os.getenv('BQ_MAXIMUM_BYTES_BILLED', 10 * 1024 ** 3))
+GA_EXTRACT_CURSOR_STAGE = 'ga_extract'
+# Also read the streaming events_intraday_YYYYMMDD tables until the daily export replaces them
+GA_READ_INTRADAY = os.getenv('GA_READ_INTRADAY', '1') == '1'
+GA_INTRADAY_CURSOR_STAGE = 'ga_extract_intraday'
 
 def init_google_credentials():
     try:
@@ -35,8 +48,122 @@ def init_google_credentials():
         print(f"ERROR: Failed to initialize credentials. Check your .env file. Error: {e}")
         return None
     
-def query_last_ga_events():    
+def ga_daily_table(day):
+    # GA4 export shards live next to the configured table as events_YYYYMMDD
+    dataset = current_tenant()['ga_events_table'].rsplit('.', 1)[0]
+    return f"{dataset}.events_{day.strftime('%Y%m%d')}"
+
+def ga_intraday_table(day):
+    dataset = current_tenant()['ga_events_table'].rsplit('.', 1)[0]
+    return f"{dataset}.events_intraday_{day.strftime('%Y%m%d')}"
+
+def get_ga_table_modified(client, events_table):
+    # Wildcard tables have no single modification time, those are always queried
+    if '*' in events_table:
+        return None
+    try:
+        return client.get_table(events_table).modified
+    except NotFound:
+        return None
+    except Exception as e:
+        print(f"WARNING: Could not read metadata for {events_table}: {e}")
+        return None
+
+def record_bq_job_stats(events_table, estimated_bytes, query_job):
+    duration_ms = None
+    if query_job.started and query_job.ended:
+        duration_ms = int((query_job.ended - query_job.started).total_seconds() * 1000)
+    stats = {
+        "bytes_processed": query_job.total_bytes_processed,
+        "bytes_billed": query_job.total_bytes_billed,
+        "slot_ms": query_job.slot_millis,
+        "duration_ms": duration_ms,
+        "cache_hit": query_job.cache_hit
+    }
+    print(f"BigQuery job {query_job.job_id}: {stats}")
+    try:
+        run_query(
+            """
+            INSERT INTO bq_job_stats (
+                run_at, tenant, table_name, job_id, estimated_bytes,
+                bytes_processed, bytes_billed, slot_ms, duration_ms, cache_hit
+            )
+            VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            (
+                current_tenant()['name'], events_table, query_job.job_id, estimated_bytes,
+                stats['bytes_processed'], stats['bytes_billed'], stats['slot_ms'], stats['duration_ms'], stats['cache_hit']
+            )
+        )
+    except Exception as e:
+        print(f"WARNING: Could not record BigQuery job stats: {e}")
+
+def query_last_ga_events():
+    # Returns (events, watermarks). Pass the watermarks to save_ga_extract_cursors once the events
+    # are inserted, so a failed insert leaves the tables to be read again.
+    events_table = current_tenant()['ga_events_table']
     client = bigquery.Client(credentials=init_google_credentials())
+
+    # Skip BigQuery entirely when the export table hasn't changed since the last extraction
+    modified = get_ga_table_modified(client, events_table)
+    previous = get_cursor(GA_EXTRACT_CURSOR_STAGE)
+    if modified and previous and previous.get('table') == events_table and previous.get('modified') == modified.isoformat():
+        print(f"{events_table} unchanged since {modified.isoformat()}, skipping extraction.")
+        events = []
+    else:
+        events = query_ga_events(events_table, client)
+    watermarks = []
+    if modified and events is not None:
+        watermarks.append((GA_EXTRACT_CURSOR_STAGE, {"table": events_table, "modified": modified.isoformat()}))
+
+    # Intraday tables change independently of the configured table, so they are always checked
+    if GA_READ_INTRADAY:
+        intraday_events, extracted = query_intraday_ga_events(client)
+        events = (events or []) + intraday_events
+        watermarks.append((GA_INTRADAY_CURSOR_STAGE, extracted))
+    return events, watermarks
+
+def save_ga_extract_cursors(watermarks):
+    for stage, cursor in watermarks:
+        save_cursor(stage, cursor)
+
+def query_intraday_ga_events(client):
+    # Same-day events from the streaming export. GA deletes an intraday table once that day's daily
+    # table lands; the daily rows then hit the (ga_user_pseudo_id, event_timestamp) key and are skipped.
+    local_today = datetime.now(pytz.timezone(current_tenant()['org_timezone'])).date()
+    previous = get_cursor(GA_INTRADAY_CURSOR_STAGE) or {}
+    extracted = {}
+    events = []
+    for day in (local_today - timedelta(days=1), local_today):
+        if get_ga_table_modified(client, ga_daily_table(day)):
+            continue
+        intraday_table = ga_intraday_table(day)
+        modified = get_ga_table_modified(client, intraday_table)
+        if not modified:
+            continue
+        if previous.get(intraday_table) == modified.isoformat():
+            print(f"{intraday_table} unchanged since {modified.isoformat()}, skipping extraction.")
+            extracted[intraday_table] = modified.isoformat()
+            continue
+
+        # Only tables that were actually read are recorded; a refused or failed one is retried next tick
+        try:
+            day_events = query_ga_events(intraday_table, client)
+        except Exception as e:
+            print(f"ERROR: Failed to extract {intraday_table}: {e}")
+            continue
+        if day_events is None:
+            continue
+        events.extend(day_events)
+        extracted[intraday_table] = modified.isoformat()
+
+    return events, extracted
+
+def query_ga_events(events_table, client=None):
+    # Returns None when the byte cap refused the query, so callers don't advance their watermarks
+    client = client or bigquery.Client(credentials=init_google_credentials())
+    # events_* also matches the intraday shards, which are read separately
+    daily_only = "AND _TABLE_SUFFIX NOT LIKE 'intraday_%'" if '*' in events_table and GA_READ_INTRADAY else ""
     query_sql = f"""
         # Category 1: Purchase-related events
         (
@@ -54,9 +181,10 @@ def query_last_ga_events():
                 ecommerce,
                 items
             FROM
-                `{GA_EVENTS_TABLE}`
+                `{events_table}`
             WHERE
                 event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
+                {daily_only}
         )
 
         UNION ALL
@@ -77,9 +205,10 @@ def query_last_ga_events():
                 ecommerce,
                 items
             FROM
-                `{GA_EVENTS_TABLE}`
+                `{events_table}`
             WHERE
                 EXISTS (SELECT 1 FROM UNNEST(event_params) AS param WHERE param.key IN ('source', 'medium', 'campaign', 'term', 'content'))
+                {daily_only}
         )
 
         UNION ALL
@@ -88,18 +217,20 @@ def query_last_ga_events():
         (
             WITH excluded_users AS (
                 SELECT DISTINCT user_pseudo_id
-                FROM `{GA_EVENTS_TABLE}`
+                FROM `{events_table}`
                 WHERE 
-                    event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
-                    OR EXISTS (SELECT 1 FROM UNNEST(event_params) AS param WHERE param.key LIKE 'utm_%')
+                    (event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
+                    OR EXISTS (SELECT 1 FROM UNNEST(event_params) AS param WHERE param.key LIKE 'utm_%'))
+                    {daily_only}
             ),
             earliest_events AS (
                 SELECT
                     *,
                     ROW_NUMBER() OVER(PARTITION BY user_pseudo_id ORDER BY event_timestamp) AS rn
-                FROM `{GA_EVENTS_TABLE}`
+                FROM `{events_table}`
                 WHERE
                     user_pseudo_id NOT IN (SELECT user_pseudo_id FROM excluded_users)
+                    {daily_only}
             )
             SELECT
                 event_date,
@@ -123,8 +254,19 @@ def query_last_ga_events():
         ORDER BY event_timestamp DESC;
     """
 
-    query_job = client.query(query_sql)
+    dry_run_job = client.query(query_sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+    estimated_bytes = dry_run_job.total_bytes_processed
+    print(f"BigQuery dry run for {events_table}: ~{estimated_bytes / 1024 ** 2:.1f} MiB")
+    if estimated_bytes > BQ_MAXIMUM_BYTES_BILLED:
+        print(f"ERROR: Query over {events_table} would scan {estimated_bytes} bytes (limit {BQ_MAXIMUM_BYTES_BILLED}), skipping.")
+        return None
+
+    query_job = client.query(query_sql, job_config=bigquery.QueryJobConfig(
+        maximum_bytes_billed=BQ_MAXIMUM_BYTES_BILLED,
+        use_query_cache=True
+    ))
     results = query_job.result()
+    record_bq_job_stats(events_table, estimated_bytes, query_job)
     
     processed_rows = []
     for row in results:
@@ -198,22 +340,44 @@ def insert_ga_events(events_list):
         print("No events to insert.")
         return
         
+    # Newly inserted funnel events also get their products unnested into ga_event_items
     query_sql = """
-        INSERT INTO ga_events (
-            ga_user_pseudo_id,
-            event_name,
-            event_timestamp,
-            event_timestamp_numeric,
-            utm_source,
-            utm_campaign,
-            utm_medium,
-            event_params
+        WITH new_events AS (
+            INSERT INTO ga_events (
+                ga_user_pseudo_id,
+                event_name,
+                event_timestamp,
+                event_timestamp_numeric,
+                utm_source,
+                utm_campaign,
+                utm_medium,
+                event_params,
+                basket_signature
+            )
+            VALUES %s
+            ON CONFLICT (ga_user_pseudo_id, event_timestamp) DO NOTHING
+            RETURNING ga_user_pseudo_id, event_timestamp, event_name, event_params
         )
-        VALUES %s
-        ON CONFLICT (ga_user_pseudo_id, event_timestamp) DO NOTHING
+        INSERT INTO ga_event_items (ga_user_pseudo_id, event_timestamp, line_no, event_name, item_id, price, quantity)
+        SELECT
+            new_events.ga_user_pseudo_id,
+            new_events.event_timestamp,
+            product.line_no,
+            new_events.event_name,
+            (product.item->>'item_id')::bigint,
+            (product.item->>'price')::numeric,
+            (product.item->>'quantity')::numeric
+        FROM new_events
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(new_events.event_params->'products', '[]'::jsonb))
+            WITH ORDINALITY AS product (item, line_no)
+        ON CONFLICT DO NOTHING
     """
     print('before')
+    # Days retention has already dropped would only be re-created and dropped again
+    retention_cutoff = ga_events_retention_cutoff()
+    skipped_expired = 0
     data_to_insert = []
+    cache_rows = []
     for event in events_list:
         # Check for required fields before processing
         if not event.get('user_pseudo_id') or not event.get('event_timestamp'):
@@ -225,14 +389,22 @@ def insert_ga_events(events_list):
         try:
             # Set local timezone to match Shopify
             utc_dt = datetime.fromtimestamp(event_timestamp_bigint / 1_000_000, tz=timezone.utc)
-            local_tz = pytz.timezone(ORG_TIMEZONE)
+            local_tz = pytz.timezone(current_tenant()['org_timezone'])
             local_dt = utc_dt.astimezone(local_tz)
             event_dt_str = local_dt.strftime('%Y-%m-%d %H:%M:%S.%f %z')
 
         except (ValueError, TypeError) as e:
             print(f"WARNING: Could not convert timestamp {event_timestamp_bigint}. Error: {e}")
             continue
+        if local_dt.date() < retention_cutoff:
+            skipped_expired += 1
+            continue
 
+        signature = basket_signature(
+            event['event_params'].get('products'),
+            event['event_params'].get('order_total'),
+            event['event_params'].get('shipping_value')
+        )
         data_to_insert.append((
             event.get('user_pseudo_id'),
             event.get('event_name'),
@@ -241,9 +413,126 @@ def insert_ga_events(events_list):
             event.get('utm_source'),
             event.get('utm_campaign'),
             event.get('utm_medium'),
-            json.dumps(event.get('event_params'))
+            json.dumps(event.get('event_params')),
+            signature
         ))
+        # Mirrors the stored row; ga_events.event_timestamp keeps the local wall time
+        cache_rows.append({
+            "ga_user_pseudo_id": event.get('user_pseudo_id'),
+            "event_name": event.get('event_name'),
+            "event_timestamp": local_dt.replace(tzinfo=None),
+            "utm_source": event.get('utm_source'),
+            "utm_campaign": event.get('utm_campaign'),
+            "utm_medium": event.get('utm_medium'),
+            "event_params": event.get('event_params'),
+            "basket_signature": signature
+        })
     
+    if skipped_expired:
+        print(f"Skipped {skipped_expired} events older than the retention cutoff {retention_cutoff}")
     # Execute the batch insert if there is data to insert
     if data_to_insert:
-        run_many_query(query_sql, data_to_insert)
+        batch_dates = [row[2][:10] for row in data_to_insert]
+        ensure_ga_events_partitions(
+            datetime.strptime(min(batch_dates), '%Y-%m-%d').date(),
+            datetime.strptime(max(batch_dates), '%Y-%m-%d').date()
+        )
+        # Raises when the write fails; rows are only cached when none of them were quarantined,
+        # since the result doesn't say which ones were
+        result = run_many_query(query_sql, data_to_insert)
+        if not result['quarantined']:
+            remember_events(cache_rows)
+
+def _month_start(d):
+    return date(d.year, d.month, 1)
+
+def _next_month(d):
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+# Tables range-partitioned by month on event_timestamp, sharing the same partition lifecycle
+GA_PARTITIONED_TABLES = ('ga_events', 'ga_event_items')
+
+def ga_events_partition_name(month_start, table='ga_events'):
+    return f"{table}_{month_start.year}_{month_start.month:02d}"
+
+def ga_events_retention_cutoff(horizon_days=None):
+    return datetime.now().date() - timedelta(days=horizon_days or ATTRIBUTION_HORIZON_DAYS)
+
+def _list_ga_partitions():
+    return run_query(
+        """
+        SELECT parent.relname AS table_name, child.relname AS partition_name
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = ANY(ARRAY['ga_events'::regclass, 'ga_event_items'::regclass])
+        """, fetch_all=True
+    ) or []
+
+# Partition names known to exist, per tenant, so warm invocations skip the catalog lookup
+_known_partitions = {}
+
+def ensure_ga_events_partitions(from_date=None, to_date=None):
+    # Creates the missing monthly partitions covering [from_date, to_date] plus
+    # GA_EVENTS_PARTITIONS_AHEAD months. Months retention removes are never re-created: a detached
+    # table would still hold the name, so the insert would find no partition.
+    today = datetime.now().date()
+    month = max(_month_start(from_date or today), _month_start(ga_events_retention_cutoff()))
+    last_month = _month_start(max(to_date or today, today))
+    for _ in range(GA_EVENTS_PARTITIONS_AHEAD):
+        last_month = _next_month(last_month)
+
+    wanted = []
+    while month <= last_month:
+        wanted.extend((table, month) for table in GA_PARTITIONED_TABLES)
+        month = _next_month(month)
+
+    known = _known_partitions.setdefault(current_tenant()['name'], set())
+    if all(ga_events_partition_name(month, table) in known for table, month in wanted):
+        return
+    known.update(partition['partition_name'] for partition in _list_ga_partitions())
+
+    for table, month in wanted:
+        name = ga_events_partition_name(month, table)
+        if name in known:
+            continue
+        run_query(
+            f"""
+            CREATE TABLE IF NOT EXISTS {name}
+            PARTITION OF {table}
+            FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')
+            """
+        )
+        known.add(name)
+
+def apply_ga_events_retention(horizon_days=None, action=None, deadline=None):
+    # Detaches (and by default drops) monthly partitions entirely older than the attribution horizon
+    horizon_days = horizon_days or ATTRIBUTION_HORIZON_DAYS
+    action = action or GA_EVENTS_RETENTION_ACTION
+    cutoff = ga_events_retention_cutoff(horizon_days)
+
+    partitions = _list_ga_partitions()
+
+    removed = []
+    for partition in partitions:
+        if deadline_passed(deadline):
+            print("Time budget exhausted, remaining partitions are left for the next run.")
+            break
+        table = partition.get('table_name')
+        name = partition.get('partition_name')
+        name_match = re.fullmatch(rf'{table}_(\d{{4}})_(\d{{2}})', name or '')
+        if not name_match:
+            continue
+        month = date(int(name_match.group(1)), int(name_match.group(2)), 1)
+        if _next_month(month) > cutoff:
+            continue
+
+        run_query(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        if action == 'drop':
+            run_query(f"DROP TABLE IF EXISTS {name}")
+        _known_partitions.get(current_tenant()['name'], set()).discard(name)
+        removed.append(name)
+
+    if removed:
+        print(f"Retention ({action}, horizon {horizon_days} days): {', '.join(removed)}")
+    return removed
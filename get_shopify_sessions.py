@@ -1,173 +1,422 @@
 import os, time, requests, json, re
-from db import run_query
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from db import run_query, run_many_query
+from basket import basket_signature
+from tenants import current_tenant
+from pipeline_state import deadline_passed, get_cursor, save_cursor
 import pandas as pd
 
-def get_orders_data(api_key: str, domain: str, created_at_min: str):
+# The poll keeps its own updated_at watermark, re-reading an overlap window each time so
+# orders that were in flight around the last poll are picked up again
+SHOPIFY_POLL_CURSOR_STAGE = 'shopify_poll'
+SHOPIFY_POLL_OVERLAP_MINUTES = int(os.getenv('SHOPIFY_POLL_OVERLAP_MINUTES', 10))
+SHOPIFY_POLL_LOOKBACK_DAYS = int(os.getenv('SHOPIFY_POLL_LOOKBACK_DAYS', 3))
+# Retries for rate-limited (429) or failing (5xx) Admin API calls
+SHOPIFY_MAX_RETRIES = int(os.getenv('SHOPIFY_MAX_RETRIES', 5))
+
+def parse_landing_site_url(url_string):
+    parsed_url = urlparse(url_string)
+    query_params = parse_qs(parsed_url.query)
+
+    utm_source = query_params.get('utm_source', [None])[0]
+    utm_medium = query_params.get('utm_medium', [None])[0]
+    utm_campaign = query_params.get('utm_campaign', [None])[0]
+    utm_content = query_params.get('utm_content', [None])[0]
+    utm_term = query_params.get('utm_term', [None])[0]
+    gad_campaignid = query_params.get('gad_campaignid', [None])[0]
+    gbraid = query_params.get('gbraid', [None])[0]
+    gclid = query_params.get('gclid', [None])[0]
+
+    target_page = parsed_url.path
+    final_target_page = re.sub(r'[^a-zA-Z0-9/\-]', '', target_page)
+
+    return {
+        "utm_source": utm_source,
+        "utm_medium": utm_medium,
+        "utm_campaign": utm_campaign,
+        "utm_content": utm_content,
+        "utm_term": utm_term,
+        "gad_campaignid": gad_campaignid,
+        "gbraid": gbraid,
+        "gclid": gclid,
+        "path": target_page,
+        "target_page": final_target_page
+    }
+
+def map_shopify_order(order):
+    # Shared by the REST poller and the orders/create, orders/updated webhooks (same payload shape)
+    customer = order.get('customer') or {}
+    customer_email = customer.get('email')
+    customer_first_name = customer.get('first_name')
+    customer_last_name = customer.get('last_name')
+    customer_created_at = customer.get('created_at')
+    billing_address = order.get('billing_address') or {}
+    customer_phone = billing_address.get('phone')
+    products_list = []
+    products_total_price = 0.0
+    line_items = order.get('line_items', [])
+    for item in line_items:
+        product_id = item.get('product_id')
+        product_price = float(item.get('price', '0.0'))
+        product_quantity = float(item.get('quantity', '0.0'))
+        
+        products_list.append({
+            "item_id": product_id,
+            "price": product_price,
+            "quantity": product_quantity
+        })
+        products_total_price += product_price * product_quantity
+
+    order_total = float(order.get('total_price', '0.0'))
+    delivery_price = order_total - products_total_price
+    
+    return {
+        "orderId": order.get('id'),
+        "landingSite": order.get('landing_site'),
+        "customerId": customer.get('id'),
+        "customerEmail": customer_email,
+        "customerPhone": customer_phone,
+        "customerFirstName": customer_first_name,
+        "customerLastName": customer_last_name,
+        "customerCreatedAt": customer_created_at,
+        "orderDate": order.get('created_at'),
+        "updatedAt": order.get('updated_at'),
+        "orderTotal": order_total,
+        "orderDeliveryPrice": delivery_price,
+        "products": products_list
+    }
+
+def shopify_get(url, headers, params=None):
+    # Backfill shards and the poll share the store's API bucket; on a 429 wait as long as
+    # Retry-After says, otherwise back off exponentially
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        response = requests.get(url, headers=headers, params=params)
+        if (response.status_code != 429 and response.status_code < 500) or attempt == SHOPIFY_MAX_RETRIES:
+            return response
+        try:
+            delay = float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+        print(f"Shopify returned {response.status_code}, retrying in {delay}s ({attempt + 1}/{SHOPIFY_MAX_RETRIES})")
+        time.sleep(delay)
+
+def _fetch_orders_page(page_url, headers, delay=0):
+    # Returns (mapped orders, next page url); the rate-limit pause happens here so it
+    # overlaps with whatever the consumer does with the previous page
+    if delay:
+        time.sleep(delay)
+    orders_response = shopify_get(page_url, headers)
+    orders_response.raise_for_status()
+    orders_page = orders_response.json().get('orders', [])
+
+    link_header = orders_response.headers.get('Link')
+    
+    # Use regex to find the 'rel="next"' URL reliably
+    next_url_match = re.search(r'<(.*?)>; rel="next"', link_header if link_header else '')
+    next_page_url = next_url_match.group(1) if next_url_match else None
+
+    return [map_shopify_order(order) for order in orders_page], next_page_url
+
+def iter_orders_pages(api_key: str, domain: str, created_at_min: str = None, created_at_max: str = None, updated_at_min: str = None):
+    # Yields one list of mapped orders per API page, oldest first (by updated_at when
+    # updated_at_min is given, by created_at otherwise). The next page is already being
+    # fetched while the caller writes the current one. Raises RequestException on failure.
     orders_url = f"https://{domain}/admin/api/2023-10/orders.json"
     headers = {
         "X-Shopify-Access-Token": api_key,
         "Content-Type": "application/json"
     }
 
-    all_orders = []
-    initial_params = {
-        "limit": 50,
-        "created_at_min": created_at_min
-    }
-    
+    # status=any: Shopify only returns open orders by default
+    initial_params = {"limit": 50, "status": "any"}
+    if updated_at_min:
+        initial_params["updated_at_min"] = updated_at_min
+        initial_params["order"] = "updated_at asc"
+    else:
+        initial_params["created_at_min"] = created_at_min
+        initial_params["order"] = "created_at asc"
+    if created_at_max:
+        initial_params["created_at_max"] = created_at_max
 
     next_page_url = f"{orders_url}?{requests.compat.urlencode(initial_params)}"
 
-    while next_page_url:
-        try:
-            orders_response = requests.get(next_page_url, headers=headers)
-            orders_response.raise_for_status()
-            orders_page = orders_response.json().get('orders', [])
-
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(_fetch_orders_page, next_page_url, headers)
+        while pending:
+            orders_page, next_page_url = pending.result()
             if not orders_page:
                 break
+            pending = executor.submit(_fetch_orders_page, next_page_url, headers, 0.5) if next_page_url else None
+            yield orders_page
 
-            for order in orders_page:
-                customer = order.get('customer', {})
-                customer_email = customer.get('email')
-                customer_first_name = customer.get('first_name')
-                customer_last_name = customer.get('last_name')
-                customer_created_at = customer.get('created_at')
-                billing_address = order.get('billing_address', {})
-                customer_phone = billing_address.get('phone')
-                products_list = []
-                products_total_price = 0.0
-                line_items = order.get('line_items', [])
-                for item in line_items:
-                    product_id = item.get('product_id')
-                    product_price = float(item.get('price', '0.0'))
-                    product_quantity = float(item.get('quantity', '0.0'))
-                    
-                    products_list.append({
-                        "item_id": product_id,
-                        "price": product_price,
-                        "quantity": product_quantity
-                    })
-                    products_total_price += product_price * product_quantity
-
-                order_total = float(order.get('total_price', '0.0'))
-                delivery_price = order_total - products_total_price
-                
-                order_data = {
-                    "orderId": order.get('id'),
-                    "landingSite": order.get('landing_site'),
-                    "customerId": customer.get('id'),
-                    "customerEmail": customer_email,
-                    "customerPhone": customer_phone,
-                    "customerFirstName": customer_first_name,
-                    "customerLastName": customer_last_name,
-                    "customerCreatedAt": customer_created_at,
-                    "orderDate": order.get('created_at'),
-                    "orderTotal": order_total,
-                    "orderDeliveryPrice": delivery_price,
-                    "products": products_list
-                }
-                all_orders.append(order_data)
-
-            link_header = orders_response.headers.get('Link')
-            
-            # Use regex to find the 'rel="next"' URL reliably
-            next_url_match = re.search(r'<(.*?)>; rel="next"', link_header if link_header else '')
-            
-            if next_url_match:
-                next_page_url = next_url_match.group(1)
-            else:
-                next_page_url = None
-            
-            time.sleep(0.5)
-
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to get orders: {e}")
-            return None
+def get_orders_data(api_key: str, domain: str, created_at_min: str, created_at_max: str = None):
+    all_orders = []
+    try:
+        for orders_page in iter_orders_pages(api_key, domain, created_at_min, created_at_max):
+            all_orders.extend(orders_page)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to get orders: {e}")
+        return None
 
     return all_orders
 
+def iter_last_shopify_order_pages():
+    # Reconciliation poll. Webhooks write orders too, so the watermark can't come from the
+    # orders table: only this poll advances it, once the caller has written a page.
+    cursor = get_cursor(SHOPIFY_POLL_CURSOR_STAGE) or {}
+    if cursor.get('updated_at'):
+        updated_at_min = datetime.fromisoformat(cursor['updated_at']) - timedelta(minutes=SHOPIFY_POLL_OVERLAP_MINUTES)
+    else:
+        updated_at_min = datetime.now(timezone.utc) - timedelta(days=SHOPIFY_POLL_LOOKBACK_DAYS)
 
-def extract_last_shopify_orders():
-    last_order_date = run_query(
-        """
-        SELECT shopify_order_date
-        FROM orders 
-        ORDER BY shopify_order_date DESC
-        LIMIT 1;
-        """, (), fetch_one=True
-    ).get('shopify_order_date')
-
-    shopify_api_key = os.getenv('SHOPIFY_API_KEY')
-    shopify_domain = os.getenv('SHOPIFY_DOMAIN')
+    shopify_api_key = current_tenant()['shopify_api_key']
+    shopify_domain = current_tenant()['shopify_domain']
     
     if not shopify_api_key or not shopify_domain:
         print("Shopify credentials not found. Please set SHOPIFY_API_KEY and SHOPIFY_DOMAIN in your .env file.")
-    else:
-        # Get the current date and set the time to 00:00:00
-        start_date_iso = last_order_date.isoformat()
-        
-        print(f"Fetching new purchases from Shopify since {start_date_iso}...")
-        orders_data = get_orders_data(shopify_api_key, shopify_domain, start_date_iso)
-        
-        if orders_data:
-            return orders_data
-        else:
-            print("No new purchases found or an error occurred.")
+        return
 
-def insert_or_update_customer_from_order(order_data):
-    run_query(
-        """
-        INSERT INTO customers (
-            shopify_customer_id,
-            shopify_customer_email,
-            shopify_customer_phone,
-            shopify_customer_first_name,
-            shopify_customer_last_name,
-            shopify_customer_created_at
-        )
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (shopify_customer_id) 
-        DO UPDATE SET
-            shopify_customer_email = EXCLUDED.shopify_customer_email,
-            shopify_customer_phone = EXCLUDED.shopify_customer_phone,
-            shopify_customer_first_name = EXCLUDED.shopify_customer_first_name,
-            shopify_customer_last_name = EXCLUDED.shopify_customer_last_name
-        """,
-        (
-            order_data.get('customerId'),
-            order_data.get('customerEmail'),
-            order_data.get('customerPhone'),
-            order_data.get('customerFirstName'),
-            order_data.get('customerLastName'),
-            order_data.get('customerCreatedAt')
-        )
+    print(f"Fetching orders updated in Shopify since {updated_at_min.isoformat()}...")
+    try:
+        for orders_page in iter_orders_pages(shopify_api_key, shopify_domain, updated_at_min=updated_at_min.isoformat()):
+            yield orders_page
+            # Only reached when the caller asks for the next page, i.e. this one is written
+            updated = [datetime.fromisoformat(order['updatedAt']) for order in orders_page if order.get('updatedAt')]
+            if updated:
+                save_cursor(SHOPIFY_POLL_CURSOR_STAGE, {"updated_at": max(updated).isoformat()})
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to get orders: {e}")
+
+CUSTOMER_UPSERT_SQL = """
+    INSERT INTO customers (
+        shopify_customer_id,
+        shopify_customer_email,
+        shopify_customer_phone,
+        shopify_customer_first_name,
+        shopify_customer_last_name,
+        shopify_customer_created_at
+    )
+    VALUES {values}
+    ON CONFLICT (shopify_customer_id) 
+    DO UPDATE SET
+        shopify_customer_email = EXCLUDED.shopify_customer_email,
+        shopify_customer_phone = EXCLUDED.shopify_customer_phone,
+        shopify_customer_first_name = EXCLUDED.shopify_customer_first_name,
+        shopify_customer_last_name = EXCLUDED.shopify_customer_last_name
+    -- Repeat orders usually carry identical details; skipping them avoids a new tuple, WAL and vacuum work
+    WHERE (
+        customers.shopify_customer_email,
+        customers.shopify_customer_phone,
+        customers.shopify_customer_first_name,
+        customers.shopify_customer_last_name
+    ) IS DISTINCT FROM (
+        EXCLUDED.shopify_customer_email,
+        EXCLUDED.shopify_customer_phone,
+        EXCLUDED.shopify_customer_first_name,
+        EXCLUDED.shopify_customer_last_name
     )
+"""
 
-def insert_order_data(order_data):
-    run_query(
-        """
+# Inserted or changed orders (orders/updated edits, landing data filled in later) also write
+# their products to order_items, so product-level queries don't have to unnest JSONB.
+# Order writes take a per-schema advisory lock first, so each upsert statement snapshots the
+# orders the previous writer committed and `previous` holds their real totals. An edit to an
+# already matched order moves the difference into attribution_daily and bumps matched_at, so
+# the rollup and the /orders/attributed validators follow without a rebuild. Payloads older than
+# the stored shopify_updated_at are ignored: Shopify doesn't deliver webhooks in order.
+ORDER_UPSERT_SQL = """
+    SELECT pg_advisory_xact_lock(hashtext(current_schema() || '.orders'));
+    WITH upserted AS (
         INSERT INTO orders (
             shopify_order_id,
             shopify_customer_id,
             shopify_order_date,
             shopify_order_total,
             shopify_delivery_price,
-            shopify_order_products
+            shopify_order_products,
+            landing_site,
+            landing_utm_source,
+            gad_campaignid,
+            target_page,
+            basket_signature,
+            shopify_updated_at
         )
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (shopify_order_id) DO NOTHING
-        """,
-        (
-            order_data.get('orderId'),
-            order_data.get('customerId'),
-            order_data.get('orderDate'),
+        VALUES {values}
+        ON CONFLICT (shopify_order_id) DO UPDATE SET
+            shopify_customer_id = EXCLUDED.shopify_customer_id,
+            shopify_order_total = EXCLUDED.shopify_order_total,
+            shopify_delivery_price = EXCLUDED.shopify_delivery_price,
+            shopify_order_products = EXCLUDED.shopify_order_products,
+            basket_signature = EXCLUDED.basket_signature,
+            landing_site = COALESCE(EXCLUDED.landing_site, orders.landing_site),
+            landing_utm_source = COALESCE(EXCLUDED.landing_utm_source, orders.landing_utm_source),
+            gad_campaignid = COALESCE(EXCLUDED.gad_campaignid, orders.gad_campaignid),
+            target_page = COALESCE(EXCLUDED.target_page, orders.target_page),
+            shopify_updated_at = EXCLUDED.shopify_updated_at,
+            matched_at = CASE
+                WHEN orders.ga_user_pseudo_id IS NOT NULL AND (
+                    orders.shopify_customer_id,
+                    orders.shopify_order_total,
+                    orders.shopify_delivery_price
+                ) IS DISTINCT FROM (
+                    EXCLUDED.shopify_customer_id,
+                    EXCLUDED.shopify_order_total,
+                    EXCLUDED.shopify_delivery_price
+                ) THEN NOW()
+                ELSE orders.matched_at
+            END
+        WHERE (orders.shopify_updated_at IS NULL OR EXCLUDED.shopify_updated_at >= orders.shopify_updated_at)
+            AND (
+                orders.shopify_customer_id,
+                orders.shopify_order_total,
+                orders.shopify_delivery_price,
+                orders.shopify_order_products,
+                orders.landing_site,
+                orders.shopify_updated_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.shopify_customer_id,
+                EXCLUDED.shopify_order_total,
+                EXCLUDED.shopify_delivery_price,
+                EXCLUDED.shopify_order_products,
+                COALESCE(EXCLUDED.landing_site, orders.landing_site),
+                EXCLUDED.shopify_updated_at
+            )
+        RETURNING shopify_order_id, shopify_order_date, shopify_order_total, shopify_order_products,
+            ga_user_pseudo_id, utm_source, utm_medium, utm_campaign, utm_term
+    ),
+    previous AS (
+        -- Same snapshot as the upsert, so these are the totals before it
+        SELECT orders.shopify_order_id, orders.shopify_order_total
+        FROM orders
+        JOIN upserted ON upserted.shopify_order_id = orders.shopify_order_id
+    ),
+    revised_attribution AS (
+        INSERT INTO attribution_daily (day, utm_source, utm_medium, utm_campaign, utm_term, revenue, order_count)
+        SELECT
+            DATE(upserted.shopify_order_date),
+            COALESCE(upserted.utm_source, ''),
+            COALESCE(upserted.utm_medium, ''),
+            COALESCE(upserted.utm_campaign, ''),
+            COALESCE(upserted.utm_term, ''),
+            SUM(COALESCE(upserted.shopify_order_total, 0) - COALESCE(previous.shopify_order_total, 0)),
+            0
+        FROM upserted
+        JOIN previous ON previous.shopify_order_id = upserted.shopify_order_id
+        WHERE upserted.ga_user_pseudo_id IS NOT NULL
+            AND upserted.shopify_order_total IS DISTINCT FROM previous.shopify_order_total
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT (day, utm_source, utm_medium, utm_campaign, utm_term)
+        DO UPDATE SET revenue = attribution_daily.revenue + EXCLUDED.revenue
+    ),
+    removed_lines AS (
+        DELETE FROM order_items
+        USING upserted
+        WHERE order_items.shopify_order_id = upserted.shopify_order_id
+            AND order_items.line_no > jsonb_array_length(COALESCE(upserted.shopify_order_products, '[]'::jsonb))
+    )
+    INSERT INTO order_items (shopify_order_id, line_no, shopify_order_date, item_id, price, quantity)
+    SELECT
+        upserted.shopify_order_id,
+        product.line_no,
+        upserted.shopify_order_date,
+        (product.item->>'item_id')::bigint,
+        (product.item->>'price')::numeric,
+        (product.item->>'quantity')::numeric
+    FROM upserted
+    CROSS JOIN LATERAL jsonb_array_elements(COALESCE(upserted.shopify_order_products, '[]'::jsonb))
+        WITH ORDINALITY AS product (item, line_no)
+    ON CONFLICT (shopify_order_id, line_no) DO UPDATE SET
+        shopify_order_date = EXCLUDED.shopify_order_date,
+        item_id = EXCLUDED.item_id,
+        price = EXCLUDED.price,
+        quantity = EXCLUDED.quantity
+    WHERE (order_items.item_id, order_items.price, order_items.quantity)
+        IS DISTINCT FROM (EXCLUDED.item_id, EXCLUDED.price, EXCLUDED.quantity)
+"""
+
+def customer_row(order_data):
+    return (
+        order_data.get('customerId'),
+        order_data.get('customerEmail'),
+        order_data.get('customerPhone'),
+        order_data.get('customerFirstName'),
+        order_data.get('customerLastName'),
+        order_data.get('customerCreatedAt')
+    )
+
+def order_row(order_data):
+    landing_site = order_data.get('landingSite')
+    landing_params = parse_landing_site_url(landing_site) if landing_site else {}
+    return (
+        order_data.get('orderId'),
+        order_data.get('customerId'),
+        order_data.get('orderDate'),
+        order_data.get('orderTotal'),
+        order_data.get('orderDeliveryPrice'),
+        json.dumps(order_data.get('products')),
+        landing_site,
+        landing_params.get('utm_source'),
+        landing_params.get('gad_campaignid'),
+        landing_params.get('target_page'),
+        basket_signature(
+            order_data.get('products'),
             order_data.get('orderTotal'),
-            order_data.get('orderDeliveryPrice'),
-            json.dumps(order_data.get('products'))
-        )
+            order_data.get('orderDeliveryPrice')
+        ),
+        order_data.get('updatedAt')
     )
 
+def upsert_customers_batch(orders_data):
+    # Repeated customers in the batch collapse to their latest details: one row, one write at most
+    customers = {}
+    for order_data in orders_data:
+        if order_data.get('customerId'):
+            customers[order_data['customerId']] = customer_row(order_data)
+    if not customers:
+        return {"seen": len(orders_data), "unique": 0, "changed": 0}
+
+    # Raises on failure: the orders that follow reference these customers and would only fail
+    # on the foreign key without saying why
+    try:
+        result = run_many_query(CUSTOMER_UPSERT_SQL.format(values="%s"), [customers[key] for key in sorted(customers)])
+    except RuntimeError as e:
+        raise RuntimeError(f"Customer upsert failed, orders of this batch were not written: {e}") from e
+    return {"seen": len(orders_data), "unique": len(customers), "changed": result.get('affected', 0)}
+
+def sync_orders(orders_pages, deadline=None):
+    # Pages arrive oldest first and each page is one batch write; the poll only advances its
+    # watermark past pages that were written, so stopping at the deadline leaves no gap
+    synced = 0
+    customer_stats = {"seen": 0, "unique": 0, "changed": 0}
+    for orders_page in orders_pages:
+        if deadline_passed(deadline):
+            print(f"Time budget exhausted after {synced} orders, the rest is left for the next run.")
+            break
+        page_customer_stats = upsert_orders_batch(orders_page)
+        for key in customer_stats:
+            customer_stats[key] += page_customer_stats[key]
+        synced += len(orders_page)
+
+    print(f"Customers: {customer_stats['seen']} in orders, {customer_stats['unique']} unique, {customer_stats['changed']} rows written")
+    return synced
+
+def upsert_orders_batch(orders_data):
+    # One execute_values round trip per table; duplicates collapse to the latest payload,
+    # since ON CONFLICT DO UPDATE can't touch the same row twice in one statement. Rows go in
+    # key order so concurrent writers (poll, queue drains) lock them in the same order.
+    orders = {}
+    for order_data in orders_data:
+        if order_data.get('orderId'):
+            orders[order_data['orderId']] = order_row(order_data)
+
+    # Customers first: orders reference them
+    customer_stats = upsert_customers_batch(orders_data)
+    if orders:
+        run_many_query(ORDER_UPSERT_SQL.format(values="%s"), [orders[key] for key in sorted(orders)])
+    return customer_stats
+
 def get_products_by_ids(item_ids_dict):
     def clean_handle(handle):
         if pd.isna(handle) or not isinstance(handle, str):
@@ -201,8 +450,8 @@ def get_products_by_ids(item_ids_dict):
     if not item_ids_dict:
         return {}
     
-    shopify_api_key = os.getenv('SHOPIFY_API_KEY')
-    shopify_domain = os.getenv('SHOPIFY_DOMAIN')
+    shopify_api_key = current_tenant()['shopify_api_key']
+    shopify_domain = current_tenant()['shopify_domain']
     
     products_url = f"https://{shopify_domain}/admin/api/2023-10/products.json"
     headers = {
@@ -224,7 +473,7 @@ def get_products_by_ids(item_ids_dict):
         }
 
         try:
-            response = requests.get(products_url, headers=headers, params=params)
+            response = shopify_get(products_url, headers, params)
             response.raise_for_status()
 
             products_page = response.json().get('products', [])
@@ -245,3 +494,36 @@ def get_products_by_ids(item_ids_dict):
             
     return all_products_with_handles
 
+
+
+def get_product_handles_cached(item_ids_dict):
+    # Resolves handles from the products table and only asks Shopify for ids it hasn't seen yet
+    item_ids = [item_id for item_id in item_ids_dict.keys() if item_id is not None]
+    if not item_ids:
+        return {}
+
+    rows = run_query(
+        """
+        SELECT shopify_product_id, handle
+        FROM products
+        WHERE shopify_product_id = ANY(%s)
+        """, (item_ids,), fetch_all=True
+    ) or []
+    handles = {row['shopify_product_id']: row['handle'] for row in rows}
+
+    missing = {item_id: '' for item_id in item_ids if item_id not in handles}
+    if missing:
+        print(f"Resolving {len(missing)} product handles from Shopify...")
+        fetched = get_products_by_ids(missing)
+        if fetched:
+            run_many_query(
+                """
+                INSERT INTO products (shopify_product_id, handle)
+                VALUES %s
+                ON CONFLICT (shopify_product_id) DO UPDATE SET handle = EXCLUDED.handle
+                """,
+                list(fetched.items())
+            )
+        handles.update(fetched)
+
+    return handles
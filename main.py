@@ -1,21 +1,73 @@
-from fastapi import FastAPI
-from get_ga_db import query_last_ga_events, insert_ga_events
-from get_shopify_sessions import extract_last_shopify_orders, insert_or_update_customer_from_order, insert_order_data
-from match_orders import process_orders
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import FastAPI, Request, Response, Query, HTTPException, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from get_ga_db import query_last_ga_events, insert_ga_events, save_ga_extract_cursors, ensure_ga_events_partitions, apply_ga_events_retention
+from get_shopify_sessions import iter_last_shopify_order_pages, sync_orders
+from match_orders import process_orders, MATCH_WORKERS
+from profiling import profile_stage
+from pipeline_state import new_deadline, deadline_passed
+from shopify_webhooks import verify_shopify_hmac, enqueue_webhook_order, drain_order_queue, ORDER_WEBHOOK_TOPICS
+from tenants import load_tenants, get_tenant, get_tenant_by_domain, use_tenant, tenant_connection_share, TENANT_CONCURRENCY
+from attribution_rollups import query_attribution_daily
+from attributed_orders import query_attributed_orders, get_last_match_time, ATTRIBUTED_ORDERS_PAGE_SIZE
 
 app = FastAPI()
 
-def main_run():
-    ga_events = query_last_ga_events()
-    if ga_events:
-        insert_ga_events(ga_events)
+def main_run(match_workers=None, deadline=None):
+    # Every stage checks the shared deadline; unfinished work resumes on the next tick
+    deadline = deadline or new_deadline()
+    with profile_stage("ga_extract"):
+        ensure_ga_events_partitions()
+        ga_events, ga_watermarks = query_last_ga_events() if not deadline_passed(deadline) else (None, [])
+    with profile_stage("ga_insert"):
+        if ga_events is not None and not deadline_passed(deadline):
+            insert_ga_events(ga_events)
+            # Only now: insert_ga_events raises on a failed write and the tables are read again next tick
+            save_ga_extract_cursors(ga_watermarks)
 
-    orders_data = extract_last_shopify_orders()
-    for order in orders_data:
-        insert_or_update_customer_from_order(order)
-        insert_order_data(order)
-    process_orders()
-    print("Task ended")
+    with profile_stage("shopify_sync"):
+        try:
+            drain_order_queue(deadline=deadline)
+        except Exception as e:
+            print(f"Webhook queue drain failed, orders stay queued: {e}")
+        # Polling stays as the reconciliation path for missed or failed webhooks
+        if not deadline_passed(deadline):
+            sync_orders(iter_last_shopify_order_pages(), deadline=deadline)
+    with profile_stage("match_orders"):
+        process_orders(workers=match_workers, deadline=deadline)
+    with profile_stage("retention"):
+        apply_ga_events_retention(deadline=deadline)
+    print("Task ended" if not deadline_passed(deadline) else "Task ended at the time budget, resuming next run")
+
+def run_tenant(tenant, tenant_count, deadline=None):
+    with use_tenant(tenant):
+        print(f"Running tenant {tenant['name']}")
+        try:
+            # The tenant's own limit (or MATCH_WORKERS), never more than its share of the pool
+            match_workers = min(tenant.get('max_concurrency') or MATCH_WORKERS, tenant_connection_share(tenant_count))
+            main_run(match_workers=match_workers, deadline=deadline)
+        except Exception as e:
+            print(f"Tenant {tenant['name']} failed: {e}")
+            return {"tenant": tenant['name'], "status": "failed", "error": str(e)}
+    return {"tenant": tenant['name'], "status": "ok"}
+
+def run_all_tenants():
+    # Each store runs its own extraction and matching; TENANT_CONCURRENCY bounds how many run at once
+    tenants = load_tenants()
+    deadline = new_deadline()
+    with ThreadPoolExecutor(max_workers=max(1, min(TENANT_CONCURRENCY, len(tenants)))) as executor:
+        return list(executor.map(run_tenant, tenants, [len(tenants)] * len(tenants), [deadline] * len(tenants)))
+
+def resolve_tenant(name):
+    try:
+        return get_tenant(name)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/")
 def index():
@@ -23,5 +75,110 @@ def index():
 
 @app.get("/run-db-update")
 def run_db_update():
-    main_run()
-    return {"status": "ok", "message": "Job executed"}
+    results = run_all_tenants()
+    failed = [result['tenant'] for result in results if result['status'] != 'ok']
+    if failed:
+        return {"status": "failed", "message": f"Job failed for {', '.join(failed)}", "tenants": results}
+    return {"status": "ok", "message": "Job executed", "tenants": results}
+
+@app.get("/attribution/daily")
+def attribution_daily(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    utm_source: Optional[str] = None,
+    utm_medium: Optional[str] = None,
+    utm_campaign: Optional[str] = None,
+    tenant: Optional[str] = None
+):
+    end_date = end_date or date.today()
+    start_date = start_date or end_date - timedelta(days=30)
+    with use_tenant(resolve_tenant(tenant)):
+        rows = query_attribution_daily(start_date, end_date, utm_source, utm_medium, utm_campaign)
+    return {"start_date": start_date, "end_date": end_date, "rows": rows}
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and last_modified:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.get("/orders/attributed")
+def attributed_orders(
+    request: Request,
+    response: Response,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    utm_source: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(ATTRIBUTED_ORDERS_PAGE_SIZE, ge=1, le=5000),
+    tenant: Optional[str] = None
+):
+    with use_tenant(resolve_tenant(tenant)):
+        return _attributed_orders_response(request, response, start_date, end_date, utm_source, after, limit)
+
+def _attributed_orders_response(request, response, start_date, end_date, utm_source, after, limit):
+    # Validators come from the latest match time, so polling clients get a 304 until something new is attributed
+    last_match = get_last_match_time()
+    if last_match and last_match.tzinfo is None:
+        last_match = last_match.replace(tzinfo=timezone.utc)
+    last_modified = last_match.astimezone(timezone.utc) if last_match else None
+    etag = '"' + hashlib.sha1(f"{last_match}|{request.url.query}".encode('utf-8')).hexdigest() + '"'
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        orders, next_cursor = query_attributed_orders(start_date, end_date, utm_source, after, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    response.headers.update(headers)
+    return {"orders": orders, "next_cursor": next_cursor}
+
+def _handle_order_webhook(tenant, payload):
+    with use_tenant(tenant):
+        return enqueue_webhook_order(payload)
+
+def _drain_tenant_queue(tenant):
+    with use_tenant(tenant):
+        try:
+            drain_order_queue()
+        except Exception as e:
+            print(f"Webhook queue drain failed, orders stay queued for the next tick: {e}")
+
+@app.post("/webhooks/shopify/orders")
+async def shopify_order_webhook(request: Request, background_tasks: BackgroundTasks):
+    raw_body = await request.body()
+    try:
+        tenant = get_tenant_by_domain(request.headers.get('x-shopify-shop-domain'))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown shop")
+
+    if not verify_shopify_hmac(raw_body, request.headers.get('x-shopify-hmac-sha256'), tenant.get('shopify_webhook_secret')):
+        raise HTTPException(status_code=401, detail="Invalid HMAC")
+
+    topic = request.headers.get('x-shopify-topic')
+    if topic not in ORDER_WEBHOOK_TOPICS:
+        return {"status": "ignored", "topic": topic}
+
+    try:
+        payload = json.loads(raw_body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed JSON body")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Expected an order object")
+
+    order_id = await run_in_threadpool(_handle_order_webhook, tenant, payload)
+    background_tasks.add_task(_drain_tenant_queue, tenant)
+    return {"status": "queued", "order_id": order_id}
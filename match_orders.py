@@ -1,17 +1,42 @@
-import json 
-from datetime import timedelta, datetime 
-from db import run_query 
-
-def query_orders_with_no_pseudo_ids():
-    yesterday = datetime.now().date() - timedelta(days=1)
-    orders = run_query( 
-        """ 
-        SELECT * FROM orders  
-        WHERE ga_user_pseudo_id IS NULL and shopify_order_date > %s
-        ORDER BY shopify_order_date
-        """, (yesterday,), fetch_all=True 
-    )
-    return orders
+import os, json, time, argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, datetime, date
+from db import run_query, run_many_query, stream_query, worker_connection
+from basket import basket_signature
+from tenants import current_tenant, use_tenant, get_tenant
+from pipeline_state import deadline_passed
+from event_cache import find_cached_purchases, cached_last_touch_events, refresh_event_cache, event_cache_stats
+
+# Number of parallel matching workers; each one uses its own database connection
+MATCH_WORKERS = int(os.getenv('MATCH_WORKERS', 1))
+MATCH_SLICE_SIZE = int(os.getenv('MATCH_SLICE_SIZE', 25))
+# How long a claimed order stays invisible to other matchers; also the retry interval for orders without a match yet
+MATCH_LEASE_SECONDS = int(os.getenv('MATCH_LEASE_SECONDS', 240))
+
+def claim_unmatched_orders(since, limit, run_started):
+    # Work queue over orders: SKIP LOCKED lets concurrent matchers take disjoint batches, and
+    # match_claimed_at acts as a lease. An order is claimable when it was never claimed, or its
+    # lease expired and it wasn't already tried by this run.
+    since = since or datetime.now().date() - timedelta(days=1)
+    orders = run_query(
+        """
+        UPDATE orders
+        SET match_claimed_at = NOW()
+        WHERE shopify_order_id IN (
+            SELECT shopify_order_id FROM orders
+            WHERE ga_user_pseudo_id IS NULL AND shopify_order_date > %s
+                AND (
+                    match_claimed_at IS NULL
+                    OR (match_claimed_at < NOW() - %s * INTERVAL '1 second' AND match_claimed_at < %s)
+                )
+            ORDER BY shopify_order_date, shopify_order_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+        """, (since, MATCH_LEASE_SECONDS, run_started, limit), fetch_all=True
+    ) or []
+    return sorted(orders, key=lambda order: (order['shopify_order_date'], order['shopify_order_id']))
 
 def query_orders_on_date_range(order_with_no_ga_id): 
     if not order_with_no_ga_id: 
@@ -36,15 +61,39 @@ def query_orders_on_date_range(order_with_no_ga_id):
         for p in shopify_products 
     ] 
 
-    # Define the date range 
+    # Define the date range as a half-open timestamp range so ga_events partitions get pruned
     start_date = base_date - timedelta(days=1) 
-    end_date = base_date + timedelta(days=1) 
+    end_date = base_date + timedelta(days=2) 
+
+    # Fast path: equality lookup on the precomputed basket signature
+    signature = order_with_no_ga_id.get('basket_signature') or basket_signature(shopify_products, order_total, delivery_price)
+
+    # Answered from memory when the hot cache holds every day of the window
+    cached = find_cached_purchases(start_date, end_date, order_total, delivery_price, shopify_products, signature)
+    if cached is not None:
+        return cached
 
+    if signature:
+        purchases = run_query(
+            """
+            SELECT * FROM ga_events
+            WHERE
+                basket_signature = %s
+                AND event_timestamp >= %s AND event_timestamp < %s
+                AND event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
+            """,
+            (signature, start_date, end_date),
+            fetch_all=True
+        )
+        if purchases:
+            return purchases
+
+    # Fallback for events ingested before signatures existed or baskets that only partially match
     query = """ 
         SELECT * FROM ga_events  
         WHERE 
             event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
-            AND DATE(event_timestamp) BETWEEN %s AND %s 
+            AND event_timestamp >= %s AND event_timestamp < %s 
             AND (event_params->>'order_total')::numeric = %s 
             AND (event_params->>'shipping_value')::numeric = %s 
             AND event_params->'products' @> %s::jsonb 
@@ -58,6 +107,74 @@ def query_orders_on_date_range(order_with_no_ga_id):
      
     return purchases 
 
+def query_known_customer_purchases(order):
+    # Repeat customers: only look at the pseudo IDs already attributed to this customer
+    customer_id = order.get('shopify_customer_id')
+    if not customer_id:
+        return []
+
+    base_date = order['shopify_order_date'].date()
+    signature = order.get('basket_signature') or basket_signature(
+        order['shopify_order_products'], order['shopify_order_total'], order['shopify_delivery_price']
+    )
+    ga_products_to_match = [
+        {"item_id": p['item_id'], "price": float(p['price']), "quantity": p['quantity']}
+        for p in order['shopify_order_products']
+    ]
+
+    purchases = run_query(
+        """
+        SELECT * FROM ga_events
+        WHERE
+            ga_user_pseudo_id = ANY(
+                SELECT UNNEST(ga_user_pseudo_id) FROM customers WHERE shopify_customer_id = %s
+            )
+            AND event_timestamp >= %s AND event_timestamp < %s
+            AND event_name IN ('purchase', 'form_submit', 'add_payment_info', 'add_shipping_info', 'begin_checkout', 'add_to_cart')
+            AND (
+                basket_signature = %s
+                OR (
+                    (event_params->>'order_total')::numeric = %s
+                    AND (event_params->>'shipping_value')::numeric = %s
+                    AND event_params->'products' @> %s::jsonb
+                )
+            )
+        """,
+        (
+            customer_id,
+            base_date - timedelta(days=1),
+            base_date + timedelta(days=2),
+            signature,
+            order['shopify_order_total'],
+            order['shopify_delivery_price'],
+            json.dumps(ga_products_to_match)
+        ),
+        fetch_all=True
+    )
+    return purchases or []
+
+def append_customer_pseudo_ids(customer_pseudo_ids):
+    # customer_pseudo_ids: list of (shopify_customer_id, ga_user_pseudo_id) from one matching pass
+    grouped = {}
+    for customer_id, pseudo_id in customer_pseudo_ids:
+        if customer_id and pseudo_id:
+            grouped.setdefault(customer_id, set()).add(pseudo_id)
+    if not grouped:
+        return
+
+    run_many_query(
+        """
+        UPDATE customers
+        SET ga_user_pseudo_id = ARRAY(
+            SELECT DISTINCT UNNEST(COALESCE(customers.ga_user_pseudo_id, '{}') || new_ids.pseudo_ids::text[])
+        )
+        FROM (VALUES %s) AS new_ids (shopify_customer_id, pseudo_ids)
+        WHERE customers.shopify_customer_id = new_ids.shopify_customer_id
+            AND NOT (COALESCE(customers.ga_user_pseudo_id, '{}') @> new_ids.pseudo_ids::text[])
+        """,
+        [(customer_id, sorted(pseudo_ids)) for customer_id, pseudo_ids in grouped.items()]
+    )
+
 def get_last_events_by_pseudo_id(pseudo_id, is_referral=False):
     # AND utm_campaign != '(referral)' | optional condition, to be double-checked
     ref_line = "AND utm_campaign != '(referral)'"
@@ -66,28 +183,44 @@ def get_last_events_by_pseudo_id(pseudo_id, is_referral=False):
     query = f""" 
         SELECT event_name, event_timestamp, utm_source, utm_campaign, utm_medium, utm_term
         FROM ga_events
-        WHERE ga_user_pseudo_id = '{pseudo_id}' AND utm_source IS NOT NULL 
+        WHERE ga_user_pseudo_id = %s AND utm_source IS NOT NULL 
         {ref_line}
         ORDER BY event_timestamp DESC
     """ 
 
-    events = run_query( 
-        query,
-        fetch_all=True 
-    ) 
-
-    return events 
+    # Streamed: a long-lived pseudo ID can carry a lot of history
+    return stream_query(query, (pseudo_id,), row_format="dict")
 
 def update_order_with_pseudo_id_and_utms(shopify_order_id, pseudo_id, utm_source, utm_campaign, utm_medium, utm_term):
+    # Matching and the attribution_daily delta are applied in one statement, so a retried
+    # or concurrent match of the same order can't count its revenue twice
     query = """
-    UPDATE orders
-    SET 
-        ga_user_pseudo_id = %s,
-        utm_source = %s,
-        utm_campaign = %s,
-        utm_medium = %s,
-        utm_term = %s
-    WHERE shopify_order_id = %s
+    WITH matched AS (
+        UPDATE orders
+        SET 
+            ga_user_pseudo_id = %s,
+            utm_source = %s,
+            utm_campaign = %s,
+            utm_medium = %s,
+            utm_term = %s,
+            matched_at = NOW()
+        WHERE shopify_order_id = %s AND ga_user_pseudo_id IS NULL
+        RETURNING shopify_order_date, shopify_order_total, utm_source, utm_medium, utm_campaign, utm_term
+    )
+    INSERT INTO attribution_daily (day, utm_source, utm_medium, utm_campaign, utm_term, revenue, order_count)
+    SELECT
+        DATE(shopify_order_date),
+        COALESCE(utm_source, ''),
+        COALESCE(utm_medium, ''),
+        COALESCE(utm_campaign, ''),
+        COALESCE(utm_term, ''),
+        shopify_order_total,
+        1
+    FROM matched
+    ON CONFLICT (day, utm_source, utm_medium, utm_campaign, utm_term)
+    DO UPDATE SET
+        revenue = attribution_daily.revenue + EXCLUDED.revenue,
+        order_count = attribution_daily.order_count + EXCLUDED.order_count
     """
     run_query(
         query,
@@ -104,10 +237,7 @@ def update_order_with_pseudo_id_and_utms(shopify_order_id, pseudo_id, utm_source
 def set_min_event_delta_utms(last_events, purchase_date_obj):
     min_event_delta_utms = { "delta": timedelta.max, "utms": {} } 
 
-    if len(last_events) == 0: 
-        return min_event_delta_utms
-
-    for event in last_events:
+    for event in last_events or []:
         event_date = event.get('event_timestamp') 
         if isinstance(event_date, str): 
             event_date_obj = datetime.strptime(event_date, "%Y-%m-%d %H:%M:%S") 
@@ -130,86 +260,183 @@ def set_min_event_delta_utms(last_events, purchase_date_obj):
 
     return min_event_delta_utms
 
-def process_orders(): 
-    orders = query_orders_with_no_pseudo_ids()
-
-    if not orders: 
-        print("No orders found without a GA pseudo ID to process.") 
-        return 
+def find_last_touch_utms(pseudo_id, purchase_date_obj):
+    # (referral) touches only count when nothing else precedes the purchase; each pass uses the
+    # hot cache when it can vouch for the closest touch, Postgres otherwise
+    for is_referral in (False, True):
+        last_events = cached_last_touch_events(pseudo_id, is_referral, purchase_date_obj)
+        if last_events is None:
+            last_events = get_last_events_by_pseudo_id(pseudo_id, is_referral)
+        min_event_delta_utms = set_min_event_delta_utms(last_events, purchase_date_obj)
+        if min_event_delta_utms['utms'] != {}:
+            return min_event_delta_utms
+    return min_event_delta_utms
 
-    for order in orders: 
-        print(f"Processing order: {order.get('shopify_order_id')}") 
+def match_order(order):
+    # Returns the matched ga_user_pseudo_id, or None
+    print(f"Processing order: {order.get('shopify_order_id')}") 
+    matched_purchases = query_known_customer_purchases(order)
+    if matched_purchases:
+        print("Matched via known customer pseudo IDs")
+    else:
         matched_purchases = query_orders_on_date_range(order) 
 
-        if not matched_purchases: 
-            print(order)
-            print("No matching purchases found for this order. Continuing...") 
-            print("---") 
-            continue 
+    if not matched_purchases: 
+        print(order)
+        print("No matching purchases found for this order. Continuing...") 
+        print("---") 
+        return None
+
+    min_delta = {"delta": timedelta.max, "ga_user_pseudo_id": None} 
+     
+    # Correctly handle a date that may be a string or a datetime object 
+    order_date = order.get('shopify_order_date') 
+    if isinstance(order_date, str): 
+        order_date_obj = datetime.strptime(order_date, "%Y-%m-%d %H:%M:%S") 
+    elif isinstance(order_date, datetime): 
+        order_date_obj = order_date 
+    else: 
+        print(f"Skipping order due to unsupported date format: {order_date}") 
+        print("---") 
+        return None
 
-        min_delta = {"delta": timedelta.max, "ga_user_pseudo_id": None} 
+    for purchase in matched_purchases: 
+        try: 
+            purchase_date = purchase.get('event_timestamp') 
+            if isinstance(purchase_date, str): 
+                purchase_date_obj = datetime.strptime(purchase_date, "%Y-%m-%d %H:%M:%S") 
+            elif isinstance(purchase_date, datetime): 
+                purchase_date_obj = purchase_date 
+            else: 
+                print(f"Skipping order due to unsupported date format: {purchase_date}") 
+                print("---") 
+                continue 
+
+            # Calculate the absolute time difference 
+            delta = abs(order_date_obj - purchase_date_obj) 
+            delta_in_seconds = delta.total_seconds() 
+
+            if delta_in_seconds < min_delta.get('delta').total_seconds(): 
+                min_delta['delta'] = delta 
+                min_delta['ga_user_pseudo_id'] = purchase.get('ga_user_pseudo_id') 
          
-        # Correctly handle a date that may be a string or a datetime object 
-        order_date = order.get('shopify_order_date') 
-        if isinstance(order_date, str): 
-            order_date_obj = datetime.strptime(order_date, "%Y-%m-%d %H:%M:%S") 
-        elif isinstance(order_date, datetime): 
-            order_date_obj = order_date 
-        else: 
-            print(f"Skipping order due to unsupported date format: {order_date}") 
+        except Exception as e: 
+            print(f"Error processing purchase timestamp: {e}") 
             print("---") 
             continue 
+    
+    if min_delta.get('ga_user_pseudo_id'): 
+        print(f"Matched GA purchase with delta {min_delta.get('delta')}: {min_delta.get('ga_user_pseudo_id')}")
+        min_event_delta_utms = find_last_touch_utms(min_delta.get('ga_user_pseudo_id'), purchase_date_obj)
 
-        for purchase in matched_purchases: 
-            try: 
-                purchase_date = purchase.get('event_timestamp') 
-                if isinstance(purchase_date, str): 
-                    purchase_date_obj = datetime.strptime(purchase_date, "%Y-%m-%d %H:%M:%S") 
-                elif isinstance(purchase_date, datetime): 
-                    purchase_date_obj = purchase_date 
-                else: 
-                    print(f"Skipping order due to unsupported date format: {purchase_date}") 
-                    print("---") 
-                    continue 
-
-                # Calculate the absolute time difference 
-                delta = abs(order_date_obj - purchase_date_obj) 
-                delta_in_seconds = delta.total_seconds() 
-
-                if delta_in_seconds < min_delta.get('delta').total_seconds(): 
-                    min_delta['delta'] = delta 
-                    min_delta['ga_user_pseudo_id'] = purchase.get('ga_user_pseudo_id') 
-             
-            except Exception as e: 
-                print(f"Error processing purchase timestamp: {e}") 
-                print("---") 
-                continue 
-        
-        if min_delta.get('ga_user_pseudo_id'): 
-            print(f"Matched GA purchase with delta {min_delta.get('delta')}: {min_delta.get('ga_user_pseudo_id')}")
-            last_events = get_last_events_by_pseudo_id(min_delta.get('ga_user_pseudo_id'))
-            min_event_delta_utms = set_min_event_delta_utms(last_events, purchase_date_obj)
-
-            if min_event_delta_utms['utms'] == {}: 
-                last_events = get_last_events_by_pseudo_id(min_delta.get('ga_user_pseudo_id'), True) # include (referral)
-                min_event_delta_utms = set_min_event_delta_utms(last_events, purchase_date_obj)
-
-            if min_event_delta_utms.get('utms') != {}:
-                print(min_event_delta_utms.get('utms'))
-            else:
-                print("no utms found")
-
-            update_order_with_pseudo_id_and_utms(
-                shopify_order_id=order.get('shopify_order_id'), 
-                pseudo_id=min_delta.get('ga_user_pseudo_id'), 
-                utm_campaign=min_event_delta_utms.get('utms').get('utm_campaign', ""),
-                utm_source=min_event_delta_utms.get('utms').get('utm_source', ""),
-                utm_medium=min_event_delta_utms.get('utms').get('utm_medium', ""),
-                utm_term=min_event_delta_utms.get('utms').get('utm_term', "")
-                )
-        else: 
-            print("Could not find a valid match for this order.")
+        if min_event_delta_utms.get('utms') != {}:
+            print(min_event_delta_utms.get('utms'))
+        else:
+            print("no utms found")
 
+        update_order_with_pseudo_id_and_utms(
+            shopify_order_id=order.get('shopify_order_id'), 
+            pseudo_id=min_delta.get('ga_user_pseudo_id'), 
+            utm_campaign=min_event_delta_utms.get('utms').get('utm_campaign', ""),
+            utm_source=min_event_delta_utms.get('utms').get('utm_source', ""),
+            utm_medium=min_event_delta_utms.get('utms').get('utm_medium', ""),
+            utm_term=min_event_delta_utms.get('utms').get('utm_term', "")
+            )
         print("---")
+        return min_delta.get('ga_user_pseudo_id')
+
+    print("Could not find a valid match for this order.")
+    print("---")
+    return None
+
+def match_orders_shard(worker_id, orders, tenant=None):
+    # Each worker holds a single connection for its whole shard
+    started = time.monotonic()
+    customer_pseudo_ids = []
+    with use_tenant(tenant or current_tenant()), worker_connection():
+        for order in orders:
+            try:
+                pseudo_id = match_order(order)
+                if pseudo_id:
+                    customer_pseudo_ids.append((order.get('shopify_customer_id'), pseudo_id))
+            except Exception as e:
+                print(f"Worker {worker_id}: failed to match order {order.get('shopify_order_id')}: {e}")
+        # Still inside use_tenant: pool threads have no tenant of their own
+        append_customer_pseudo_ids(customer_pseudo_ids)
+    matched = len(customer_pseudo_ids)
+    elapsed = time.monotonic() - started
+    return {
+        "worker": worker_id,
+        "orders": len(orders),
+        "matched": matched,
+        "seconds": round(elapsed, 2),
+        "orders_per_second": round(len(orders) / elapsed, 2) if elapsed > 0 else None
+    }
+
+def match_orders_slice(orders, workers):
+    # Returns the number of matched orders; a single worker runs the same shard code inline
+    if workers == 1:
+        stats = [match_orders_shard(0, orders)]
+    else:
+        # Round-robin shards keep each worker's slice spread across the whole date range
+        shards = [orders[i::workers] for i in range(workers)]
+        print(f"Matching {len(orders)} orders on {workers} workers...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(match_orders_shard, range(workers), shards, [current_tenant()] * workers))
 
+    for worker_stats in stats:
+        print(
+            f"Worker {worker_stats['worker']}: {worker_stats['matched']}/{worker_stats['orders']} matched "
+            f"in {worker_stats['seconds']}s ({worker_stats['orders_per_second']} orders/s)"
+        )
+    return sum(worker_stats['matched'] for worker_stats in stats)
+
+def refresh_cache_for_orders(orders, cache_range):
+    # Verifies the event cache for the days these orders' match windows need, on top of the
+    # range already verified in this run; returns the verified range
+    order_days = [order['shopify_order_date'].date() for order in orders]
+    start_date = min(order_days) - timedelta(days=1)
+    end_date = max(order_days) + timedelta(days=2)
+    if cache_range:
+        if cache_range[0] <= start_date and end_date <= cache_range[1]:
+            return cache_range
+        start_date, end_date = min(start_date, cache_range[0]), max(end_date, cache_range[1])
+    refresh_event_cache(start_date, end_date)
+    return start_date, end_date
+
+def process_orders(workers=None, since=None, deadline=None): 
+    # Claims MATCH_SLICE_SIZE orders per worker at a time until the queue is empty or the deadline
+    # passes. Leases make this safe to run from several invocations at once, and whatever is left
+    # unclaimed is where the next tick continues.
+    workers = max(1, workers or MATCH_WORKERS)
+    run_started = run_query("SELECT NOW() AS now", fetch_one=True)['now']
+    processed = 0
+    matched = 0
+    cache_range = None
+    while True:
+        if deadline_passed(deadline):
+            print(f"Time budget exhausted after {processed} orders, the rest is left for the next run.")
+            return {"processed": processed, "matched": matched, "complete": False}
+
+        orders_slice = claim_unmatched_orders(since, MATCH_SLICE_SIZE * workers, run_started)
+        if not orders_slice:
+            break
+        cache_range = refresh_cache_for_orders(orders_slice, cache_range)
+        matched += match_orders_slice(orders_slice, min(workers, len(orders_slice)))
+        processed += len(orders_slice)
+
+    if not processed: 
+        print("No orders found without a GA pseudo ID to process.") 
+    else:
+        print(f"Event cache: {event_cache_stats()}")
+    return {"processed": processed, "matched": matched, "complete": True}
 
+if __name__ == '__main__':
+    # Backlog recovery, e.g. python match_orders.py --workers 8 --since 2025-08-01
+    parser = argparse.ArgumentParser(description="Match unmatched orders to GA events")
+    parser.add_argument('--workers', type=int, default=MATCH_WORKERS)
+    parser.add_argument('--since', type=date.fromisoformat, default=None)
+    parser.add_argument('--tenant', default=None, help="tenant name from TENANTS")
+    args = parser.parse_args()
+    with use_tenant(get_tenant(args.tenant)):
+        process_orders(workers=args.workers, since=args.since)
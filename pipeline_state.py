@@ -0,0 +1,26 @@
+import os, json, time
+from db import run_query
+
+# Serverless ticks are killed at the platform limit; stages stop a little before this budget
+PIPELINE_TIME_BUDGET_SECONDS = float(os.getenv('PIPELINE_TIME_BUDGET_SECONDS', 50))
+
+def new_deadline(budget_seconds=None):
+    return time.monotonic() + (budget_seconds or PIPELINE_TIME_BUDGET_SECONDS)
+
+def deadline_passed(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+def get_cursor(stage):
+    row = run_query("SELECT cursor FROM pipeline_cursors WHERE stage = %s", (stage,), fetch_one=True)
+    return row.get('cursor') if row else None
+
+def save_cursor(stage, cursor):
+    run_query(
+        """
+        INSERT INTO pipeline_cursors (stage, cursor, updated_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (stage) DO UPDATE SET
+            cursor = EXCLUDED.cursor,
+            updated_at = EXCLUDED.updated_at
+        """, (stage, json.dumps(cursor, default=str))
+    )
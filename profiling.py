@@ -0,0 +1,34 @@
+import os, time, cProfile, threading
+from contextlib import contextmanager
+from tenants import current_tenant
+
+# PROFILE_STAGES=1 writes one .prof file per main_run stage, readable with pstats or snakeviz
+PROFILE_STAGES = os.getenv('PROFILE_STAGES', '').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/profiles')
+
+# cProfile only sees the thread that enabled it, and on Python 3.12+ only one profiler can be
+# active per process. Profiled stages therefore run one at a time across tenant threads, and
+# threaded matching workers are not covered: use MATCH_WORKERS=1 to profile matching inline.
+_profile_lock = threading.Lock()
+
+@contextmanager
+def profile_stage(name):
+    name = f"{current_tenant()['name']}_{name}"
+    started = time.monotonic()
+    if not PROFILE_STAGES:
+        yield
+        print(f"Stage {name} took {time.monotonic() - started:.2f}s")
+        return
+
+    with _profile_lock:
+        started = time.monotonic()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.prof")
+            profiler.dump_stats(path)
+            print(f"Stage {name} took {time.monotonic() - started:.2f}s, profile saved to {path}")
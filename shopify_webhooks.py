@@ -0,0 +1,80 @@
+import os, hmac, json, base64, hashlib
+from db import run_query
+from get_shopify_sessions import map_shopify_order, upsert_orders_batch
+from pipeline_state import deadline_passed
+
+ORDER_WEBHOOK_TOPICS = ('orders/create', 'orders/updated')
+ORDER_QUEUE_BATCH_SIZE = int(os.getenv('ORDER_QUEUE_BATCH_SIZE', 500))
+ORDER_QUEUE_LEASE_SECONDS = int(os.getenv('ORDER_QUEUE_LEASE_SECONDS', 120))
+
+def verify_shopify_hmac(raw_body: bytes, hmac_header: str, secret: str):
+    if not secret or not hmac_header:
+        return False
+    digest = hmac.new(secret.encode('utf-8'), raw_body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('utf-8'), hmac_header)
+
+def enqueue_webhook_order(payload):
+    # Only the latest payload per order is kept, by Shopify's updated_at since deliveries can
+    # arrive out of order; the queue is drained in batches. A newer payload releases the claim
+    # so it gets drained even if an older one is being upserted right now.
+    order_data = map_shopify_order(payload)
+    if not order_data.get('orderId'):
+        print("Webhook payload without an order id, skipping.")
+        return None
+
+    run_query(
+        """
+        INSERT INTO shopify_order_queue (shopify_order_id, order_data, received_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (shopify_order_id) DO UPDATE SET
+            order_data = EXCLUDED.order_data,
+            received_at = EXCLUDED.received_at,
+            claimed_at = NULL
+        WHERE (shopify_order_queue.order_data->>'updatedAt') IS NULL
+            OR (EXCLUDED.order_data->>'updatedAt')::timestamptz >= (shopify_order_queue.order_data->>'updatedAt')::timestamptz
+        """, (order_data['orderId'], json.dumps(order_data))
+    )
+    return order_data['orderId']
+
+def drain_order_queue(batch_size=None, deadline=None):
+    # Same lease pattern as claim_unmatched_orders: SKIP LOCKED hands concurrent drains disjoint
+    # rows and claimed_at keeps them off other drains until the lease expires. Rows are only
+    # deleted once their upsert has committed; a failed upsert raises and leaves them queued
+    # for the next drain after the lease. A payload re-queued meanwhile has a newer received_at
+    # and stays too.
+    batch_size = batch_size or ORDER_QUEUE_BATCH_SIZE
+    drained = 0
+    while not deadline_passed(deadline):
+        rows = run_query(
+            """
+            UPDATE shopify_order_queue
+            SET claimed_at = NOW()
+            WHERE shopify_order_id IN (
+                SELECT shopify_order_id FROM shopify_order_queue
+                WHERE claimed_at IS NULL OR claimed_at < NOW() - %s * INTERVAL '1 second'
+                ORDER BY received_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING shopify_order_id, order_data, received_at
+            """, (ORDER_QUEUE_LEASE_SECONDS, batch_size), fetch_all=True
+        ) or []
+        if not rows:
+            break
+
+        upsert_orders_batch([row['order_data'] for row in rows])
+        run_query(
+            """
+            DELETE FROM shopify_order_queue
+            USING UNNEST(%s::bigint[], %s::timestamptz[]) AS done (shopify_order_id, received_at)
+            WHERE shopify_order_queue.shopify_order_id = done.shopify_order_id
+                AND shopify_order_queue.received_at = done.received_at
+            """, ([row['shopify_order_id'] for row in rows], [row['received_at'] for row in rows])
+        )
+        drained += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    if drained:
+        print(f"Upserted {drained} queued webhook orders.")
+    return drained
@@ -0,0 +1,80 @@
+import os, json, threading
+from contextlib import contextmanager
+
+# TENANTS is a JSON list of stores, e.g.
+# [{"name": "store-a", "shopify_domain": "a.myshopify.com", "shopify_api_key_env": "SHOPIFY_API_KEY_A",
+#   "ga_events_table": "proj.analytics_1.events_*", "org_timezone": "Europe/Berlin",
+#   "db_schema": "store_a", "max_concurrency": 2}]
+# Without it the single store configured through SHOPIFY_* / GA_EVENTS_TABLE / ORG_TIMEZONE is used.
+# Every TENANTS entry must name its own table, schema, credentials and timezone: falling back to
+# the single-store settings would mix one store's data and credentials into another's.
+TENANT_REQUIRED_KEYS = ('name', 'shopify_domain', 'shopify_api_key_env', 'ga_events_table', 'org_timezone', 'db_schema')
+TENANT_CONCURRENCY = int(os.getenv('TENANT_CONCURRENCY', 4))
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE', 8))
+
+_current = threading.local()
+
+def _default_tenant():
+    return {
+        "name": "default",
+        "shopify_domain": os.getenv('SHOPIFY_DOMAIN'),
+        "shopify_api_key": os.getenv('SHOPIFY_API_KEY'),
+        "shopify_webhook_secret": os.getenv('SHOPIFY_WEBHOOK_SECRET'),
+        "ga_events_table": os.getenv('GA_EVENTS_TABLE'),
+        "org_timezone": os.getenv('ORG_TIMEZONE'),
+        "db_schema": None,
+        "max_concurrency": None
+    }
+
+def load_tenants():
+    raw = os.getenv('TENANTS')
+    if not raw:
+        return [_default_tenant()]
+
+    tenants = []
+    for config in json.loads(raw):
+        missing = [key for key in TENANT_REQUIRED_KEYS if not config.get(key)]
+        if missing:
+            raise ValueError(f"Tenant {config.get('name') or '?'} in TENANTS is missing: {', '.join(missing)}")
+        shopify_api_key = os.getenv(config['shopify_api_key_env'])
+        if not shopify_api_key:
+            raise ValueError(f"Tenant {config['name']}: {config['shopify_api_key_env']} is not set")
+
+        tenant = {"max_concurrency": None, **config}
+        tenant['shopify_api_key'] = shopify_api_key
+        # No secret configured means this tenant's webhooks are rejected, never checked with another store's secret
+        webhook_secret_env = config.get('shopify_webhook_secret_env')
+        tenant['shopify_webhook_secret'] = os.getenv(webhook_secret_env) if webhook_secret_env else None
+        tenants.append(tenant)
+    return tenants
+
+def current_tenant():
+    return getattr(_current, 'tenant', None) or _default_tenant()
+
+@contextmanager
+def use_tenant(tenant):
+    # Binds the tenant to this thread; worker threads must enter it themselves
+    previous = getattr(_current, 'tenant', None)
+    _current.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _current.tenant = previous
+
+def get_tenant(name=None):
+    if not name:
+        return load_tenants()[0]
+    for tenant in load_tenants():
+        if tenant['name'] == name:
+            return tenant
+    raise KeyError(f"Unknown tenant: {name}")
+
+def get_tenant_by_domain(shopify_domain):
+    for tenant in load_tenants():
+        if tenant['shopify_domain'] == shopify_domain:
+            return tenant
+    raise KeyError(f"Unknown shop: {shopify_domain}")
+
+def tenant_connection_share(tenant_count):
+    # Fair share of PG_POOL_SIZE among the tenants that can run at the same time
+    return max(1, PG_POOL_SIZE // max(1, min(tenant_count, TENANT_CONCURRENCY)))
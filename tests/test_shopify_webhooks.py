@@ -0,0 +1,98 @@
+import hmac, json, base64, hashlib
+import pytest
+
+pytest.importorskip("psycopg2")
+import shopify_webhooks
+from shopify_webhooks import verify_shopify_hmac, enqueue_webhook_order
+
+SECRET = "test-secret"
+ORDER = {
+    "id": 1001,
+    "created_at": "2025-09-01T10:00:00+02:00",
+    "updated_at": "2025-09-01T10:05:00+02:00",
+    "total_price": "45.98",
+    "landing_site": "/products/mug?utm_source=google&gad_campaignid=123",
+    "customer": {"id": 7, "email": "a@example.com"},
+    "line_items": [{"product_id": 5, "price": "19.99", "quantity": 2}]
+}
+
+def sign(body, secret=SECRET):
+    return base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode('utf-8')
+
+def test_verify_shopify_hmac_accepts_locally_signed_payload():
+    body = json.dumps(ORDER).encode('utf-8')
+    assert verify_shopify_hmac(body, sign(body), SECRET)
+
+def test_verify_shopify_hmac_rejects_tampering_and_missing_values():
+    body = json.dumps(ORDER).encode('utf-8')
+    assert not verify_shopify_hmac(body + b" ", sign(body), SECRET)
+    assert not verify_shopify_hmac(body, sign(body, "other-secret"), SECRET)
+    assert not verify_shopify_hmac(body, None, SECRET)
+    assert not verify_shopify_hmac(body, sign(body), None)
+
+def test_enqueue_stores_the_mapped_order(monkeypatch):
+    calls = []
+    monkeypatch.setattr(shopify_webhooks, "run_query", lambda query, params=None, **kwargs: calls.append(params))
+    assert enqueue_webhook_order(ORDER) == 1001
+
+    order_id, order_data = calls[0]
+    order_data = json.loads(order_data)
+    assert order_id == 1001
+    assert order_data["landingSite"] == ORDER["landing_site"]
+    assert order_data["updatedAt"] == ORDER["updated_at"]
+    assert order_data["products"] == [{"item_id": 5, "price": 19.99, "quantity": 2.0}]
+
+def test_enqueue_skips_payload_without_id(monkeypatch):
+    calls = []
+    monkeypatch.setattr(shopify_webhooks, "run_query", lambda *args, **kwargs: calls.append(args))
+    assert enqueue_webhook_order({"line_items": []}) is None
+    assert calls == []
+
+@pytest.fixture
+def webhook_client(monkeypatch):
+    pytest.importorskip("httpx")
+    main = pytest.importorskip("main")
+    from fastapi.testclient import TestClient
+
+    tenant = {"name": "default", "shopify_domain": "shop.myshopify.com", "shopify_webhook_secret": SECRET}
+    queued = []
+    monkeypatch.setattr(main, "get_tenant_by_domain", lambda domain: tenant)
+    monkeypatch.setattr(main, "enqueue_webhook_order", lambda payload: queued.append(payload) or payload.get('id'))
+    monkeypatch.setattr(main, "drain_order_queue", lambda: None)
+    return TestClient(main.app), queued
+
+def post_webhook(client, body, topic="orders/create", signature=None):
+    return client.post(
+        "/webhooks/shopify/orders",
+        content=body,
+        headers={
+            "X-Shopify-Shop-Domain": "shop.myshopify.com",
+            "X-Shopify-Topic": topic,
+            "X-Shopify-Hmac-Sha256": signature or sign(body)
+        }
+    )
+
+def test_signed_order_is_enqueued(webhook_client):
+    client, queued = webhook_client
+    response = post_webhook(client, json.dumps(ORDER).encode('utf-8'))
+    assert response.status_code == 200
+    assert response.json() == {"status": "queued", "order_id": 1001}
+    assert queued == [ORDER]
+
+def test_bad_signature_is_rejected(webhook_client):
+    client, queued = webhook_client
+    response = post_webhook(client, json.dumps(ORDER).encode('utf-8'), signature=sign(b"{}"))
+    assert response.status_code == 401
+    assert queued == []
+
+def test_malformed_signed_body_is_a_bad_request(webhook_client):
+    client, queued = webhook_client
+    for body in (b"{not json", b"[1, 2]"):
+        assert post_webhook(client, body).status_code == 400
+    assert queued == []
+
+def test_other_topics_are_ignored(webhook_client):
+    client, queued = webhook_client
+    response = post_webhook(client, json.dumps(ORDER).encode('utf-8'), topic="products/update")
+    assert response.json()["status"] == "ignored"
+    assert queued == []